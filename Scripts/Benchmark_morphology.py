@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the morphology pipeline on synthetic fish (see Synthetic_fish.py).
+
+For every image size and trait configuration (holes, fragments, missing eye, rotated...)
+it times:
+    segmented_image    : Segmented_image(file), decode, align, presence
+    measure_morphology : Measure_morphology(file) with all the landmarks and measurements
+    cli                : Morphology_main.py --input_glob on --cli_images copies, python start-up included
+and reports the median time, the throughput (images/sec) and the peak memory
+(tracemalloc peak for the classes, largest peak RSS of a specimen for the cli).
+
+The results can be saved as a baseline and later runs compared to it, the script
+exits with status 1 when a benchmark is slower than the baseline by more than --tolerance.
+    Benchmark_morphology.py --sizes 800x320 1600x640 --save_baseline baseline.json
+    Benchmark_morphology.py --sizes 800x320 1600x640 --baseline baseline.json
+
+With --coarse_factor N the benchmarks run in coarse-to-fine mode (cases named
+<size>_<variant>_coarseN) and the accuracy against the full resolution is reported:
+the largest difference of every landmark (pixel, on the row or the column) and of every
+measurement over the cases (inf when it is missing in one of the modes).
+    Benchmark_morphology.py --sizes 3200x1280 --benchmarks measure_morphology --coarse_factor 4
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from functools import partial
+import numpy as np
+import Traits_class as tc
+import Morphology_main as mm
+from Synthetic_fish import save_synthetic_fish
+
+list_size = ['800x320', '1600x640', '3200x1280', '5000x2000']
+variant_dict = {'standard': {},
+                'holes': {'holes': 10},
+                'fragments': {'fragments': 10},
+                'no_eye': {'missing_traits': ('eye',)},
+                'rotated': {'angle': 12}}
+list_benchmark = ['segmented_image', 'measure_morphology', 'cli']
+
+
+def run_segmented_image(file_name, coarse_factor=1):
+    tc.Segmented_image(file_name, coarse_factor=coarse_factor)
+
+def run_measure_morphology(file_name, coarse_factor=1):
+    measure_morph = tc.Measure_morphology(file_name, coarse_factor=coarse_factor)
+    return measure_morph.landmark, {k: measure_morph.get_measure(k) for k in mm.list_measure[1:]}
+
+def get_difference(a, b):
+    '''
+    Absolute difference of 2 landmarks (largest of row and column) or measurements, inf if one is missing
+    '''
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)) and len(a) == len(b) > 0:
+        return float(max(abs(x - y) for x, y in zip(a, b)))
+    if isinstance(a, (int, float, np.number)) and isinstance(b, (int, float, np.number)):
+        return float(abs(a - b))
+    return 0.0 if a == b else float('inf')
+
+def coarse_accuracy(file_name, coarse_factor):
+    '''
+    Difference of every landmark and measurement between the coarse-to-fine mode and the full resolution
+    return {"landmark.<key>": difference, "morphology.<name>": difference}
+    '''
+    landmark, measure = run_measure_morphology(file_name)
+    coarse_landmark, coarse_measure = run_measure_morphology(file_name, coarse_factor)
+    accuracy = {f'landmark.{k}': get_difference(v, coarse_landmark[k]) for k, v in landmark.items()}
+    accuracy.update({f'morphology.{k}': get_difference(v, coarse_measure[k]) for k, v in measure.items()})
+    return accuracy
+
+def time_function(function, file_name, repeat):
+    '''
+    Run function(file_name) repeat times, then once more with tracemalloc for the peak memory
+    '''
+    list_time = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(file_name)
+        list_time.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function(file_name)
+    peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+
+    return {'median_s': float(np.median(list_time)), 'min_s': min(list_time),
+            'images_per_s': 1 / float(np.median(list_time)), 'peak_mb': peak_mb}
+
+def time_cli(file_name, number_image, repeat, work_dir, coarse_factor=1):
+    '''
+    Run Morphology_main.py on number_image copies of file_name, repeat times
+    '''
+    input_dir = os.path.join(work_dir, 'cli_input')
+    output_dir = os.path.join(work_dir, 'cli_output')
+    shutil.rmtree(input_dir, ignore_errors=True)
+    os.makedirs(input_dir)
+    for i in range(number_image):
+        shutil.copy(file_name, os.path.join(input_dir, f'CLI_{i:04d}_segmented.png'))
+
+    profile = os.path.join(work_dir, 'cli_profile.json')
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Morphology_main.py'),
+               '--input_glob', os.path.join(input_dir, '*_segmented.png'), '--output_dir', output_dir,
+               '--profile', profile, '--coarse_factor', str(coarse_factor)]
+    list_time = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        list_time.append(time.perf_counter() - start)
+
+    with open(profile, 'r') as f:
+        total = json.load(f)['stages']['total']
+        peak_mb = total.get('peak_rss_mb', total.get('process_max_rss_mb'))
+
+    return {'median_s': float(np.median(list_time)), 'min_s': min(list_time),
+            'images_per_s': number_image / float(np.median(list_time)), 'peak_mb': peak_mb}
+
+def run_benchmark(sizes, variants, benchmarks, repeat=3, cli_images=5, coarse_factor=1):
+    '''
+    return results {"<size>_<variant>": {benchmark: {'median_s', 'min_s', 'images_per_s', 'peak_mb'}}},
+    accuracy {field: largest difference} of the coarse-to-fine mode (empty if coarse_factor is 1)
+    '''
+    results = {}
+    accuracy = {}
+    suffix = f'_coarse{coarse_factor}' if coarse_factor > 1 else ''
+    work_dir = tempfile.mkdtemp(prefix='benchmark_morphology_')
+    try:
+        for size in sizes:
+            width, height = map(int, size.split('x'))
+            for variant in variants:
+                file_name = save_synthetic_fish(os.path.join(work_dir, f'BENCH_{size}_{variant}_segmented.png'),
+                                                width=width, height=height, **variant_dict[variant])
+                case = f'{size}_{variant}{suffix}'
+                results[case] = {}
+                if 'segmented_image' in benchmarks:
+                    results[case]['segmented_image'] = time_function(
+                        partial(run_segmented_image, coarse_factor=coarse_factor), file_name, repeat)
+                if 'measure_morphology' in benchmarks:
+                    results[case]['measure_morphology'] = time_function(
+                        partial(run_measure_morphology, coarse_factor=coarse_factor), file_name, repeat)
+                if 'cli' in benchmarks:
+                    results[case]['cli'] = time_cli(file_name, cli_images, repeat, work_dir, coarse_factor)
+                if coarse_factor > 1:
+                    for field, difference in coarse_accuracy(file_name, coarse_factor).items():
+                        accuracy[field] = max(accuracy.get(field, 0.0), difference)
+                for benchmark, result in results[case].items():
+                    print(f"{case:24} {benchmark:20} {result['median_s']*1000:10.1f} ms "
+                          f"{result['images_per_s']:8.2f} img/s {result['peak_mb']:8.1f} MB")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results, accuracy
+
+def compare_baseline(results, baseline, tolerance):
+    '''
+    Compare the median times with the baseline
+    return the list of regressions (case, benchmark, ratio new/baseline)
+    '''
+    list_regression = []
+    for case, case_results in results.items():
+        for benchmark, result in case_results.items():
+            reference = baseline.get(case, {}).get(benchmark)
+            if reference is None:
+                continue
+            ratio = result['median_s'] / reference['median_s']
+            flag = 'REGRESSION' if ratio > 1 + tolerance else ''
+            print(f"{case:24} {benchmark:20} x{ratio:5.2f} {flag}")
+            if flag:
+                list_regression.append((case, benchmark, ratio))
+    return list_regression
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Benchmark Segmented_image, Measure_morphology and '
+                                     'Morphology_main.py on synthetic segmented fish.')
+    parser.add_argument('--sizes', nargs='+', default=list_size[:2],
+                        help=f'Image sizes widthxheight (default 800x320 1600x640, full set {" ".join(list_size)}).')
+    parser.add_argument('--variants', nargs='+', default=list(variant_dict), choices=list(variant_dict),
+                        help='Trait configurations (default all).')
+    parser.add_argument('--benchmarks', nargs='+', default=list_benchmark, choices=list_benchmark,
+                        help='Benchmarks to run (default all).')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs, the median is used (default 3).')
+    parser.add_argument('--cli_images', type=int, default=5, help='Number of images per cli run (default 5).')
+    parser.add_argument('--coarse_factor', type=int, default=1,
+                        help='Run in coarse-to-fine mode and report the accuracy against the full resolution (default 1).')
+    parser.add_argument('--output', help='Save the results. Format JSON file.')
+    parser.add_argument('--save_baseline', help='Save the results as the baseline. Format JSON file.')
+    parser.add_argument('--baseline', help='Compare the results with this baseline. Format JSON file.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='A benchmark slower than the baseline by more than this fraction is a regression (default 0.25).')
+    return parser
+
+def main():
+    args = argument_parser().parse_args()
+
+    results, accuracy = run_benchmark(args.sizes, args.variants, args.benchmarks, args.repeat, args.cli_images,
+                                      args.coarse_factor)
+    report = {'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                              'platform': platform.platform(), 'processor': platform.processor(),
+                              'cpu_count': os.cpu_count()},
+              'results': results}
+    if accuracy:
+        report['accuracy'] = accuracy
+        print(f'largest difference with the full resolution (coarse_factor {args.coarse_factor})')
+        for field, difference in accuracy.items():
+            print(f'{field:24} {difference:10.2f}')
+
+    for file_name in [args.output, args.save_baseline]:
+        if file_name:
+            with open(file_name, 'w') as f:
+                json.dump(report, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        list_regression = compare_baseline(results, baseline, args.tolerance)
+        if list_regression:
+            print(f'{len(list_regression)} regression(s) above {args.tolerance:.0%}', file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
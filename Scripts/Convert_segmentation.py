@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Convert segmented images (RGB png) to a compact label format read by Traits_class:
+    png : palette png, one byte per pixel instead of 3, same colors when displayed
+    npy : label map (trait index of every pixel), no png decoding
+The outputs keep the name of the input, <base_name>_segmented.png or <base_name>_segmented.npy
+    Convert_segmentation.py "Segmented/*_segmented.png" Segmented_compact --format png
+"""
+import os
+import sys
+import glob
+import argparse
+import Traits_class as tc
+
+
+def convert_segmentation(input_image, output_dir, output_format='png'):
+    '''
+    Save the label map of input_image in output_dir, return the path of the new file
+    '''
+    name = os.path.splitext(os.path.split(input_image)[1])[0]
+    output_file = os.path.join(output_dir, f'{name}.{output_format}')
+    tc.write_label_map(tc.read_label_map(input_image), output_file)
+    return output_file
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Convert segmented fish images to palette png or npy label maps.')
+    parser.add_argument('input_glob', help='Glob pattern of the segmented images, i.e "Segmented/*_segmented.png".')
+    parser.add_argument('output_dir', help='Folder of the converted images.')
+    parser.add_argument('--format', choices=['png', 'npy'], default='png',
+                        help='png: palette png (default), npy: numpy label map.')
+    return parser
+
+def main():
+    args = argument_parser().parse_args()
+    list_image = sorted(glob.glob(args.input_glob))
+    if not list_image:
+        sys.exit(f'no image matches {args.input_glob}')
+    os.makedirs(args.output_dir, exist_ok=True)
+    for input_image in list_image:
+        if os.path.abspath(os.path.dirname(input_image)) == os.path.abspath(args.output_dir) \
+           and input_image.endswith(f'.{args.format}'):
+            sys.exit('output_dir must be different from the folder of the images')
+        convert_segmentation(input_image, args.output_dir, args.format)
+
+if __name__ == '__main__':
+    main()
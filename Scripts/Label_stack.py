@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stack of label maps in one memory-mapped file, for very large batches.
+
+The segmented images are decoded once (Traits_class.read_label_map) into a .npy array
+N x H x W uint8, every label map padded with background to the biggest height and width,
+and an index <stack>_index.json lists the base_name, height and width of every specimen.
+Label_stack opens the file with np.load(mmap_mode='r'): a label map is a read-only view
+in the file, no open or decoding per specimen, and the processes reading the same stack
+share the pages of the file in memory.
+    Label_stack.py "Segmented/*_segmented.png" stack.npy
+    Morphology_main.py --label_stack stack.npy --output_dir Output
+"""
+import os
+import sys
+import glob
+import json
+import argparse
+import functools
+import numpy as np
+from PIL import Image
+import Traits_class as tc
+
+
+def get_index_file(stack_file):
+    return os.path.splitext(stack_file)[0] + '_index.json'
+
+def get_image_shape(file_name):
+    '''
+    (height, width) of a segmented image, read from the header only
+    '''
+    if file_name.endswith('.npy'):
+        return np.load(file_name, mmap_mode='r').shape[:2]
+    with Image.open(file_name) as img:
+        return img.height, img.width
+
+
+class Label_stack():
+    '''
+    Read-only access to the label maps of a stack, by position or by base_name
+    stack[base_name] -> label map (height, width) np.uint8, view in the memory-mapped file
+    '''
+    def __init__(self, stack_file):
+
+        self.stack_file = stack_file
+        self.stack = np.load(stack_file, mmap_mode='r')
+        with open(get_index_file(stack_file), 'r') as f:
+            self.index = json.load(f)
+        self.position = {row['base_name']: i for i, row in enumerate(self.index)}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        i = self.position[key] if isinstance(key, str) else key
+        row = self.index[i]
+        return self.stack[i, :row['height'], :row['width']]
+
+    @property
+    def base_names(self):
+        return [row['base_name'] for row in self.index]
+
+    @classmethod
+    def build(cls, list_image, stack_file):
+        '''
+        Decode the segmented images (file names "<base_name>_segmented.png" or .npy, see
+        Traits_class.read_label_map) in a new stack, return the Label_stack
+        '''
+        index = []
+        for file_name in list_image:
+            base_name = tc.get_base_name(file_name)
+            height, width = get_image_shape(file_name)
+            index.append({'base_name': base_name, 'height': height, 'width': width})
+
+        base_names = [row['base_name'] for row in index]
+        if len(set(base_names)) < len(base_names):
+            raise ValueError('several images have the same base_name')
+
+        shape = (len(index), max((row['height'] for row in index), default=0),
+                 max((row['width'] for row in index), default=0))
+        stack = np.lib.format.open_memmap(stack_file, mode='w+', dtype=np.uint8, shape=shape)
+        for i, (file_name, row) in enumerate(zip(list_image, index)):
+            stack[i, :row['height'], :row['width']] = tc.read_label_map(file_name)
+        stack.flush()
+        del stack
+
+        with open(get_index_file(stack_file), 'w') as f:
+            json.dump(index, f)
+        return cls(stack_file)
+
+
+@functools.lru_cache(maxsize=None)
+def open_label_stack(stack_file):
+    '''
+    Label_stack opened once per process
+    '''
+    return Label_stack(stack_file)
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Decode segmented images in a memory-mapped stack of label maps.')
+    parser.add_argument('input_glob', help='Glob pattern of the segmented images, i.e "Segmented/*_segmented.png".')
+    parser.add_argument('stack_file', help='Stack of label maps. Format NPY file, the index is saved as '
+                        '<stack>_index.json.')
+    return parser
+
+def main():
+    args = argument_parser().parse_args()
+    list_image = sorted(glob.glob(args.input_glob))
+    if not list_image:
+        sys.exit(f'no image matches {args.input_glob}')
+    stack = Label_stack.build(list_image, args.stack_file)
+    print(f'{len(stack)} label maps {stack.stack.shape[1]}x{stack.stack.shape[2]} in {args.stack_file}')
+
+if __name__ == '__main__':
+    main()
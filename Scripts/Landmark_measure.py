@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Landmark measurements of many specimens at once, from stored landmarks (no image).
+
+The landmarks of N specimens are an array (N, 18, 2) of (row, col) with a mask of the
+missing landmarks (N, 18). Every measurement of Measure_morphology.landmark_distance
+(SL_lm, HL_lm, ED_lm, pOD_lm, HD_lm...) and FA_lm are calculated with numpy for all the
+specimens together, so a new distance added to landmark_distance can be derived for a
+whole collection in seconds:
+    Landmark_measure.py "Output/*_landmark.json" measure_lm.csv
+    Landmark_measure.py Output/landmark.jsonl measure_lm.jsonl
+"""
+import os
+import sys
+import csv
+import glob
+import json
+import argparse
+import numpy as np
+import Traits_class as tc
+
+# landmark keys '1' to '18', position in the landmark array
+list_landmark = list(tc.Measure_morphology.landmark_trait)
+
+
+def landmarks_to_array(list_landmark_dict):
+    '''
+    Convert landmark dictionaries {"1": [row, col], ..., "18": [row, col]} ([] if missing)
+    to landmarks (N, 18, 2) float array (nan if missing) and missing (N, 18) bool array
+    '''
+    landmarks = np.full((len(list_landmark_dict), len(list_landmark), 2), np.nan)
+    for i, landmark_dict in enumerate(list_landmark_dict):
+        for j, key in enumerate(list_landmark):
+            value = landmark_dict.get(key)
+            if value:
+                landmarks[i, j] = value
+    return landmarks, np.isnan(landmarks).any(axis=2)
+
+def measure_landmarks(landmarks, missing=None, landmark_distance=None, decimals=2):
+    '''
+    Calculate the landmark measurements of N specimens, same values as Measure_morphology
+
+    Parameters
+    ----------
+    landmarks : array (N, 18, 2)
+        DESCRIPTION. (row, col) of the landmarks '1' to '18'
+    missing : bool array (N, 18), optional
+        DESCRIPTION. missing landmarks, by default the landmarks with a nan coordinate
+    landmark_distance : dict, optional
+        DESCRIPTION. {name: (landmark_a, landmark_b)}, by default Measure_morphology.landmark_distance
+    decimals : int
+        DESCRIPTION. rounding of the measurements
+
+    Returns
+    -------
+    measures : dict
+        DESCRIPTION. {name: array (N,)} for every distance and FA_lm, nan if a landmark is missing
+
+    '''
+    if landmark_distance is None:
+        landmark_distance = tc.Measure_morphology.landmark_distance
+    landmarks = np.asarray(landmarks, dtype=np.float64)
+    if missing is None:
+        missing = np.isnan(landmarks).any(axis=2)
+    landmarks = np.where(np.asarray(missing)[:, :, None], np.nan, landmarks)
+    position = {key: j for j, key in enumerate(list_landmark)}
+
+    measures = {}
+    for name, (key_a, key_b) in landmark_distance.items():
+        delta = landmarks[:, position[key_a]] - landmarks[:, position[key_b]]
+        measures[name] = np.round(np.hypot(delta[:, 0], delta[:, 1]), decimals)
+
+    # fish angle, orientation of the line from landmark 1 to landmark 6
+    delta = landmarks[:, position['6']] - landmarks[:, position['1']]
+    measures['FA_lm'] = np.round(np.degrees(np.arctan2(delta[:, 0], delta[:, 1])), decimals) + 0.0
+
+    return measures
+
+def read_landmarks(input_path):
+    '''
+    Read stored landmarks, a jsonl file (one row per specimen with base_name, see Output_writer)
+    or a glob pattern of landmark json files "<base_name>_landmark.json"
+    return list of base_name, list of landmark dictionaries
+    '''
+    list_name, list_landmark_dict = [], []
+    if input_path.endswith('.jsonl'):
+        with open(input_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    list_name.append(row.pop('base_name'))
+                    list_landmark_dict.append(row)
+    else:
+        for file_name in sorted(glob.glob(input_path)):
+            with open(file_name, 'r') as f:
+                list_landmark_dict.append(json.load(f))
+            list_name.append(tc.get_base_name(file_name))
+    return list_name, list_landmark_dict
+
+def write_measures(output_file, list_name, measures):
+    '''
+    Save the measurements, one row per specimen ('None' if missing), csv or jsonl by extension
+    '''
+    columns = ['base_name'] + list(measures)
+    values = np.column_stack([measures[name] for name in measures]) if measures else np.zeros((len(list_name), 0))
+    rows = ([name] + [float(v) if not np.isnan(v) else 'None' for v in row] for name, row in zip(list_name, values))
+    with open(output_file, 'w', newline='') as f:
+        if output_file.endswith('.csv'):
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                f.write(json.dumps(dict(zip(columns, row))) + '\n')
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Calculate the landmark measurements from stored landmarks.')
+    parser.add_argument('input', help='Landmarks, jsonl file with base_name (see --aggregate_dir) or glob pattern '
+                        'of landmark json files, i.e "Output/*_landmark.json".')
+    parser.add_argument('output', help='Measurements. Format CSV or JSONL file.')
+    return parser
+
+def main():
+    args = argument_parser().parse_args()
+    list_name, list_landmark_dict = read_landmarks(args.input)
+    if not list_name:
+        sys.exit(f'no landmark found in {args.input}')
+    landmarks, missing = landmarks_to_array(list_landmark_dict)
+    write_measures(args.output, list_name, measure_landmarks(landmarks, missing))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Landmark images of many specimens from stored landmarks, without calculating them again.
+
+The landmarks saved by Morphology_main (<base_name>_landmark.json or landmark.jsonl of
+--aggregate_dir) are in the coordinates of the aligned fish. For every specimen the
+segmented image (or its label map in a label stack) is only decoded and aligned with
+the same --angle_tolerance and --coarse_factor as the run, then the landmarks are drawn on it
+(Traits_class.draw_landmark), optionally at a reduced size with --scale:
+    Landmark_overlay.py "Output/*_landmark.json" "Segmented/*_segmented.png" Overlay --scale 0.5
+    Landmark_overlay.py Output/landmark.jsonl stack.npy Overlay --workers 4
+"""
+import os
+import sys
+import glob
+import argparse
+import traceback
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import Traits_class as tc
+import Label_stack as ls
+from Landmark_measure import read_landmarks
+
+
+def get_images(input_images):
+    '''
+    Segmented images of input_images, a label stack (.npy with its index) or a glob pattern
+    return {base_name: file name} or {base_name: stack file}
+    '''
+    if input_images.endswith('.npy') and os.path.isfile(ls.get_index_file(input_images)):
+        return {base_name: input_images for base_name in ls.open_label_stack(input_images).base_names}
+    return {tc.get_base_name(file_name): file_name for file_name in glob.glob(input_images)}
+
+def render_overlay(task, output_dir, scale=1, angle_tolerance=0, coarse_factor=1):
+    '''
+    Save the landmark image <base_name>_lm_image.png of a specimen
+    task: (base_name, image file or stack file, landmark dictionary)
+    return base_name, error (None if no error)
+    '''
+    base_name, input_image, landmark = task
+    try:
+        if input_image.endswith('.npy') and os.path.isfile(ls.get_index_file(input_image)):
+            input_image = ls.open_label_stack(input_image)[base_name]
+        segmented = tc.Segmented_image(input_image, align=True, angle_tolerance=angle_tolerance, base_name=base_name,
+                                       coarse_factor=coarse_factor)
+        img = tc.draw_landmark(segmented.label_map, landmark, scale, segmented.trait_color_dict)
+        img.save(os.path.join(output_dir, f'{base_name}_lm_image.png'))
+        return base_name, None
+    except Exception:
+        return base_name, traceback.format_exc()
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Draw stored landmarks on the aligned segmented images.')
+    parser.add_argument('landmarks', help='Landmarks, jsonl file with base_name (see --aggregate_dir) or glob pattern '
+                        'of landmark json files, i.e "Output/*_landmark.json".')
+    parser.add_argument('input_images', help='Glob pattern of the segmented images, i.e "Segmented/*_segmented.png", '
+                        'or stack of label maps created by Label_stack.py.')
+    parser.add_argument('output_dir', help='Folder of the landmark images, named <base_name>_lm_image.png.')
+    parser.add_argument('--scale', type=float, default=1,
+                        help='Size of the landmark images relative to the segmented image, i.e 0.5 (default 1).')
+    parser.add_argument('--angle_tolerance', type=float, default=0,
+                        help='Same value as the run that calculated the landmarks (default 0).')
+    parser.add_argument('--coarse_factor', type=int, default=1,
+                        help='Same value as the run that calculated the landmarks (default 1).')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes (default 1).')
+    return parser
+
+def main():
+    args = argument_parser().parse_args()
+    list_name, list_landmark_dict = read_landmarks(args.landmarks)
+    images = get_images(args.input_images)
+    list_task = [(name, images[name], landmark) for name, landmark in zip(list_name, list_landmark_dict)
+                 if name in images]
+    if not list_task:
+        sys.exit(f'no landmark of {args.landmarks} matches an image of {args.input_images}')
+    if len(list_task) < len(list_name):
+        print(f'{len(list_name) - len(list_task)} specimens without image skipped', file=sys.stderr)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    render = partial(render_overlay, output_dir=args.output_dir, scale=args.scale,
+                     angle_tolerance=args.angle_tolerance, coarse_factor=args.coarse_factor)
+    if args.workers > 1:
+        # a killed worker raises BrokenProcessPool instead of blocking the run
+        try:
+            with ProcessPoolExecutor(args.workers) as executor:
+                results = list(executor.map(render, list_task, chunksize=8))
+        except BrokenProcessPool:
+            sys.exit('a worker process terminated abruptly (killed, out of memory...)')
+    else:
+        results = [render(task) for task in list_task]
+
+    list_failed = [(base_name, error) for base_name, error in results if error]
+    for base_name, error in list_failed:
+        print(f'{base_name} failed\n{error}', file=sys.stderr)
+    print(f'{len(results) - len(list_failed)} landmark images saved in {args.output_dir}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Index of the metadata of many specimens (drexel_metadata_formatter outputs) by base_name.
+
+The source is a JSONL file (one metadata object with its base_name per line) or a folder
+of metadata files <base_name>.json. It is read once to build the index: the scale and
+unit of the ruler of every specimen (the only values used by Morphology_main) and the
+location of its metadata (byte offset and length in the JSONL file, or file name).
+The index is saved in one json file, so a batch looks up the scale of a specimen in a
+dictionary instead of opening and parsing its metadata file on the shared filesystem:
+    Metadata_index.py Metadata metadata_index.json
+    Morphology_main.py --input_glob "Segmented/*_segmented.png" --output_dir Output --metadata_index metadata_index.json
+"""
+import os
+import sys
+import json
+import argparse
+
+
+def read_ruler(metadata_dict):
+    '''
+    Scale and unit of the ruler of a metadata dictionary {....{ruler:{scale:xxx, unit:yyy}}}
+    return scale (float rounded to 3 decimals), unit ("cm" or "in"), "None" if there is no ruler
+    '''
+    scale = "None"
+    unit = "None"
+
+    if 'ruler' in metadata_dict:
+        scale = metadata_dict['ruler']['scale']
+        if scale != "None":
+            scale = round(scale, 3)
+        unit = metadata_dict['ruler']['unit']
+
+    return scale, unit
+
+
+class Metadata_index():
+    '''
+    Rulers {base_name: (scale, unit)} and locations {base_name: [offset, length] or file name}
+    of the metadata of a source (JSONL file or folder)
+    '''
+    def __init__(self, source, rulers, locations):
+
+        self.source = source
+        self.rulers = rulers
+        self.locations = locations
+
+    def __len__(self):
+        return len(self.rulers)
+
+    def __contains__(self, base_name):
+        return base_name in self.rulers
+
+    def get_ruler(self, base_name):
+        '''
+        (scale, unit) of the specimen, see read_ruler(), None if the specimen is not in the index
+        '''
+        ruler = self.rulers.get(base_name)
+        return tuple(ruler) if ruler is not None else None
+
+    def get(self, base_name):
+        '''
+        Complete metadata dictionary of the specimen, read from the source
+        '''
+        location = self.locations[base_name]
+        if os.path.isdir(self.source):
+            with open(os.path.join(self.source, location), 'r') as f:
+                return json.load(f)
+        offset, length = location
+        with open(self.source, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.read(length))
+
+    @classmethod
+    def build(cls, source):
+        '''
+        Read every metadata of the source once, JSONL file or folder of <base_name>.json files
+        '''
+        rulers, locations = {}, {}
+        if os.path.isdir(source):
+            for entry in sorted(os.scandir(source), key=lambda entry: entry.name):
+                if entry.name.endswith('.json') and entry.is_file():
+                    with open(entry.path, 'r') as f:
+                        metadata_dict = json.load(f)
+                    base_name = metadata_dict.get('base_name') or entry.name[:-len('.json')]
+                    rulers[base_name] = read_ruler(metadata_dict)
+                    locations[base_name] = entry.name
+        else:
+            with open(source, 'rb') as f:
+                offset = 0
+                for line_number, line in enumerate(f, 1):
+                    if line.strip():
+                        try:
+                            metadata_dict = json.loads(line)
+                            base_name = metadata_dict['base_name']
+                        except (json.JSONDecodeError, TypeError, KeyError):
+                            # a bad line doesn't stop the index of the other specimens
+                            print(f'{source} line {line_number}: not a metadata object with base_name, skipped',
+                                  file=sys.stderr)
+                        else:
+                            rulers[base_name] = read_ruler(metadata_dict)
+                            locations[base_name] = [offset, len(line)]
+                    offset += len(line)
+        return cls(os.path.abspath(source), rulers, locations)
+
+    def save(self, index_file):
+        with open(index_file, 'w') as f:
+            json.dump({'version': 1, 'source': self.source, 'rulers': self.rulers,
+                       'locations': self.locations}, f)
+
+    @classmethod
+    def load(cls, index_file):
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+        return cls(index['source'], index['rulers'], index['locations'])
+
+
+def open_metadata_index(path):
+    '''
+    Index saved by Metadata_index.py, or built from a source (JSONL file or folder)
+    '''
+    if os.path.isdir(path) or path.endswith('.jsonl'):
+        return Metadata_index.build(path)
+    return Metadata_index.load(path)
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Index the metadata of many specimens by base_name.')
+    parser.add_argument('source', help='Metadata, JSONL file with one metadata per line (with base_name) or folder '
+                        'of metadata files <base_name>.json.')
+    parser.add_argument('index_file', help='Index of the metadata. Format JSON file.')
+    return parser
+
+def main():
+    args = argument_parser().parse_args()
+    index = Metadata_index.build(args.source)
+    if not len(index):
+        sys.exit(f'no metadata found in {args.source}')
+    index.save(args.index_file)
+    print(f'{len(index)} specimens in {args.index_file}')
+
+if __name__ == '__main__':
+    main()
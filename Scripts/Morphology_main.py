@@ -6,10 +6,33 @@ Created on Tue May 24 09:21:33 2022
 @author: thibault
 """
 import Traits_class as tc
+import Output_writer as ow
+import Result_cache as rc
+import Profiler as pf
+import Label_stack as ls
+import Metadata_index as mi
+import io
+import os
+import sys
+import csv
+import glob
 import json
+import time
+import hashlib
+import itertools
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 import numpy as np
 import argparse
 
+# order of the measurements in the morphology output
+list_measure = ['base_name', 'SL_bbox', 'SL_lm', 'HL_bbox', 'HL_lm', 'pOD_bbox', 'pOD_lm', 'ED_bbox', 'ED_lm', 'HH_lm', 'EA_m','HA_m','FA_pca','FA_lm']
+# columns of the batch manifest, same names as the command line arguments
+manifest_columns = ['input_image', 'output_presence', 'metadata', 'morphology', 'landmark', 'lm_image', 'trait_store']
+
 def get_scale(metadata_file):
     '''
     Extract the scale value from metadata file    
@@ -31,16 +54,7 @@ def get_scale(metadata_file):
     with open(metadata_file, 'r') as f:
         metadata_dict = json.load(f)
         
-    scale = "None"
-    unit = "None"
-
-    if 'ruler' in metadata_dict  :
-        scale = metadata_dict['ruler']['scale']
-        if scale != "None":
-            scale = round(scale, 3)
-        unit = metadata_dict['ruler']['unit']
-        
-    return scale , unit
+    return mi.read_ruler(metadata_dict)
 
 
 # this class is used by json.dump to control that every value as the right format
@@ -56,11 +70,15 @@ class NpEncoder(json.JSONEncoder):
             return obj.tolist()
         return json.JSONEncoder.default(self, obj)
 
+def write_json(data, file_name, json_encoder=None):
+    with open(file_name, 'w') as f:
+        json.dump(data, f, cls=json_encoder)
+
 def argument_parser():
     parser = argparse.ArgumentParser(description='Extract information from segmented fish image such as presence absence,\
                                      landmarks, measures.')
-    parser.add_argument('input_image', help='Path of segmented fish image. Format PNG image file.')
-    parser.add_argument('output_presence', help='Path of output presence absence table. Format JSON file.')
+    parser.add_argument('input_image', nargs='?', help='Path of segmented fish image. Format PNG image file (RGB, palette or label) or NPY label map.')
+    parser.add_argument('output_presence', nargs='?', help='Path of output presence absence table. Format JSON file.')
     
     
     parser.add_argument('--metadata', 
@@ -71,8 +89,501 @@ def argument_parser():
                         help='Save the dictionnary of landmarks with the provided filename.')
     parser.add_argument('--lm_image', 
                         help='Save the visualisation of landmarks with the provided filename.')
+    parser.add_argument('--trait_store',
+                        help='Save the cleaned regions of the traits with the provided filename, the measurements '
+                        'can then be calculated from this file instead of the image. Format NPZ file.')
+    parser.add_argument('--metadata_index',
+                        help='Index of the metadata of many specimens built by Metadata_index.py (or JSONL file, '
+                        'or folder of <base_name>.json indexed at start). The scale of the specimens without '
+                        '--metadata is looked up by base_name.')
+    parser.add_argument('--lm_image_scale', type=float, default=1,
+                        help='Size of the landmark images relative to the segmented image, i.e 0.5 (default 1).')
+    parser.add_argument('--angle_tolerance', type=float, default=0,
+                        help='The fish is not rotated when its angle (degree) is below this value (default 0).')
+    parser.add_argument('--coarse_factor', type=int, default=1,
+                        help='Coarse-to-fine mode for high resolution images: the fish angle, presence and regions '
+                        'of interest of the traits are calculated on the image sampled every COARSE_FACTOR pixels, '
+                        'the landmarks and measurements at full resolution (default 1, full resolution).')
+    parser.add_argument('--cache_dir',
+                        help='Folder of the result cache. The outputs of a specimen are reused when the image, '
+                        'the metadata, the parameters and the code did not change.')
+    parser.add_argument('--cache_max_size', type=float,
+                        help='Maximum size of the result cache in MB, the least recently used entries are '
+                        'removed when the cache grows past it, and at the end of the run (default no limit).')
+    parser.add_argument('--profile',
+                        help='Save the wall time, cpu time and peak memory of every stage for every specimen, '
+                        'with statistics and histograms over the batch. Format JSON file.')
+    
+    batch = parser.add_argument_group('batch mode', 'Process many segmented images in a single run '
+                                      'instead of input_image/output_presence.')
+    batch.add_argument('--manifest',
+                       help='CSV or JSONL file with one specimen per row. Columns: input_image, output_presence '
+                       '(required), metadata, morphology, landmark, lm_image, trait_store (optional).')
+    batch.add_argument('--input_glob',
+                       help='Glob pattern of segmented images, i.e "Segmented/*_segmented.png". Requires --output_dir.')
+    batch.add_argument('--label_stack',
+                       help='Stack of label maps created by Label_stack.py, every specimen of the stack is processed '
+                       'like with --input_glob. Format NPY file.')
+    batch.add_argument('--output_dir',
+                       help='Folder for the outputs of --input_glob or --label_stack, named <base_name>_presence.json, '
+                       '<base_name>_morphology.json and <base_name>_landmark.json.')
+    batch.add_argument('--metadata_dir',
+                       help='Folder with the metadata files <base_name>.json used with --input_glob.')
+    batch.add_argument('--save_lm_image', action='store_true',
+                       help='With --input_glob or --label_stack, also save <base_name>_lm_image.png in --output_dir (required).')
+    batch.add_argument('--trait_store_dir',
+                       help='With --input_glob or --label_stack, also save the trait store <base_name>_traits.npz '
+                       'of every specimen in this folder.')
+    batch.add_argument('--prefetch', type=int, default=0,
+                       help='With --workers 1, read and decode the next PREFETCH images in threads while the current '
+                       'one is analysed, and save the outputs in a background thread (default 0, no prefetch).')
+    batch.add_argument('--workers', type=int, default=1,
+                       help='Number of worker processes used to process the specimens (default 1).')
+    batch.add_argument('--chunksize', type=int,
+                       help='Number of specimens sent to a worker at once (default: split the batch in 4 chunks per worker).')
+    batch.add_argument('--unordered', action='store_true',
+                       help='Collect the results as soon as they are ready instead of in the input order.')
+    batch.add_argument('--aggregate_dir',
+                       help='Save the outputs of all the specimens in consolidated files presence.<format>, '
+                       'morphology.<format> and landmark.<format> in this folder. With --input_glob, '
+                       'no json file is saved per specimen.')
+    batch.add_argument('--aggregate_format', nargs='+', default=['jsonl'], choices=ow.list_format,
+                       help='Formats of the consolidated files (default jsonl). parquet and arrow require pyarrow.')
+    batch.add_argument('--failed_log',
+                       help='Save the specimens that failed with their error. Format JSONL file.')
     return parser
 
+def get_morphology(input_image, metadata=None, align=True, with_measurement=True, with_landmark=True,
+                   angle_tolerance=0, cutoff=0.6, base_name=None, ruler=None, coarse_factor=1):
+    '''
+    Extract presence table, measurements and landmarks from a segmented image.
+    Measurements and landmarks are only calculated when they are requested.
+
+    Parameters
+    ----------
+    input_image : string or np.ndarray
+        DESCRIPTION. Path of segmented fish image (.png), label map (see Label_stack)
+        or path of a trait store (.npz, see Measure_morphology.from_trait_store)
+    metadata : string, optional
+        DESCRIPTION. Path of the metadata file (.json) used to get the scale
+    align : bool
+        DESCRIPTION. align the fish horizontally before measuring
+    with_measurement : bool
+        DESCRIPTION. calculate the measurements, otherwise measurement is None
+    with_landmark : bool
+        DESCRIPTION. calculate the landmarks, otherwise landmark is None
+    angle_tolerance : float
+        DESCRIPTION. the fish is not rotated when its angle (degree) is below this value
+    cutoff : float
+        DESCRIPTION. minimum percentage of the biggest blob of the eye to locate its landmarks
+    base_name : string, optional
+        DESCRIPTION. name of the specimen, required if input_image is a label map
+    ruler : tuple, optional
+        DESCRIPTION. (scale, unit) of the specimen (see Metadata_index, or read ahead from metadata),
+        used instead of metadata
+    coarse_factor : int
+        DESCRIPTION. coarse-to-fine mode when > 1, angle, presence and regions of interest on the
+        label map sampled every coarse_factor pixels (see Segmented_image)
+
+    Returns
+    -------
+    measure_morph : Measure_morphology
+        DESCRIPTION. object created from input_image, used for the visualization
+    presence_matrix : dict
+        DESCRIPTION. {"base_name": ..., "dorsal_fin": {"number": 1, "percentage": 1.0}, ..., "ruler": {...}}
+    measurement : dict
+        DESCRIPTION. measurements ordered as list_measure plus scale and unit
+    landmark : dict
+        DESCRIPTION. {"1": [row, col], ...,"18": [row, col]}
+
+    '''
+    # Create object measure_morphology, it inherits from Segmented_image so the image
+    # is decoded, aligned and split into trait masks only once for every output
+    if isinstance(input_image, str) and input_image.endswith('.npz'):
+        # cleaned regions already computed, with the parameters of the run that saved them
+        measure_morph = tc.Measure_morphology.from_trait_store(input_image)
+    else:
+        measure_morph = tc.Measure_morphology(input_image, align=align, cutoff=cutoff,
+                                              angle_tolerance=angle_tolerance, base_name=base_name,
+                                              coarse_factor=coarse_factor)
+    base_name = measure_morph.base_name
+    
+    # Assign variables from measure_morph
+    presence_matrix = {'base_name' : base_name, **measure_morph.presence_matrix,
+                       'ruler':{'presence' : 'no', 'scale' : 'None', 'unit' : 'None'}}
+    measurement = None
+    landmark = None
+    
+    if with_landmark:
+        with pf.stage('all_landmark'):
+            landmark = measure_morph.landmark
+        
+    if with_measurement:
+        # Collect the measurements (lm, bbox, area) in the order of list_measure
+        with pf.stage('all_measure'):
+            measurement = {'base_name': base_name}
+            measurement.update({k: measure_morph.get_measure(k) for k in list_measure[1:]})
+            measurement.update({'scale':"None", 'unit': "None"})     
+    
+    # Extract the scale from metadata file
+    # and add it to measurement dict
+    if metadata or ruler:
+        scale , unit = ruler if ruler else get_scale(metadata)
+        if measurement:
+            measurement['scale'] = scale
+            measurement['unit'] = unit 
+        
+        presence_matrix['ruler'] = {'presence' : 'yes', 'scale' : scale, 'unit' : unit}                
+    
+    return measure_morph, presence_matrix, measurement, landmark
+
+def get_code_version():
+    '''
+    Hash of the source of this script and of every module process_specimen depends on
+    (traits, metadata index, label stack, output writer, cache and profiler), a change of
+    the code invalidates the entries of the result cache
+    '''
+    list_module = [tc, mi, ls, ow, rc, pf]
+    return hashlib.sha256(''.join(rc.hash_file(file_name) for file_name in
+                                  [__file__] + [module.__file__ for module in list_module]).encode()).hexdigest()
+
+def process_specimen(input_image, output_presence=None, metadata=None, morphology=None, landmark=None, lm_image=None,
+                     angle_tolerance=0, cutoff=0.6, collect=False, cache=None, stack_key=None, lm_image_scale=1,
+                     trait_store=None, ruler=None, coarse_factor=1, image=None, image_hash=None, metadata_hash=None,
+                     save=None):
+    '''
+    Run get_morphology() on one segmented image and save the requested outputs.
+    Arguments follow the command line arguments defined in argument_parser().
+    stack_key: input_image is a label stack (see Label_stack) and the specimen is its label map stack_key (base_name)
+    collect: calculate all the outputs and return them (presence_matrix, measurement, landmark)
+    for the consolidated files of the batch mode, otherwise return None
+    cache (Result_cache.Result_cache): reuse the outputs stored for the same image, metadata,
+    parameters and code, or store them. The landmark image is always created from the image
+    with the landmarks already calculated (or stored in the cache), lm_image_scale sets its size.
+    trait_store: save the cleaned regions (see Segmented_image.save_trait_store)
+    ruler: (scale, unit) from the metadata index, used when there is no metadata file
+    image, image_hash, metadata_hash: label map of input_image and hashes of the files already
+    read by the prefetch thread (see load_specimen), input_image only names the specimen
+    save: function(file_name, write) saving the outputs, Output_writer.save_file by default
+    (i.e Background_writer.submit in the batch pipeline)
+    '''
+    save = save or ow.save_file
+    base_name = None
+    if stack_key is not None:
+        # view in the memory-mapped stack, no decoding
+        input_image, base_name = ls.open_label_stack(input_image)[stack_key] if image is None else image, stack_key
+    elif image is not None:
+        base_name = tc.get_base_name(input_image)
+    
+    output = None
+    if cache:
+        with pf.stage('cache'):
+            key = cache.get_key(input_image, metadata,
+                                {'align': True, 'cutoff': cutoff, 'angle_tolerance': angle_tolerance,
+                                 'ruler': None if metadata else ruler, 'coarse_factor': coarse_factor},
+                                base_name=base_name, image_hash=image_hash, metadata_hash=metadata_hash)
+            output = cache.get(key)
+    
+    measure_morph = None
+    if output is None:
+        # only calculate what is saved or collected, everything when it is stored in the cache
+        with_all = collect or bool(cache)
+        measure_morph, *computed = get_morphology(
+            input_image if image is None else image, metadata, with_measurement=with_all or bool(morphology),
+            with_landmark=with_all or bool(landmark or lm_image), angle_tolerance=angle_tolerance, cutoff=cutoff,
+            base_name=base_name, ruler=ruler, coarse_factor=coarse_factor)
+        output = tuple(computed)
+        if cache:
+            cache.put(key, output, json_encoder=NpEncoder)
+    elif lm_image or trait_store:
+        # outputs from the cache, the image is only decoded and aligned to draw the stored landmarks
+        measure_morph = tc.Measure_morphology(input_image if image is None else image, align=True, cutoff=cutoff,
+                                              angle_tolerance=angle_tolerance, base_name=base_name,
+                                              coarse_factor=coarse_factor)
+    presence_matrix, measurement, landmark_dict = output
+    
+    with pf.stage('save_outputs'):
+        if output_presence:
+            save(output_presence, partial(write_json, presence_matrix))
+              
+        # Save the dictionnaries in json file
+        # use NpEncoder to convert the value to correct type (np.int64 -> int)
+        if morphology:        
+            save(morphology, partial(write_json, measurement, json_encoder=NpEncoder))
+        
+        if landmark:
+            save(landmark, partial(write_json, landmark_dict))
+                  
+        if lm_image:        
+            # create landmark visualization image and save it
+            img_landmark = measure_morph.visualize_landmark(lm_image_scale, landmark=landmark_dict)
+            save(lm_image, img_landmark.save)
+        
+        if trait_store:
+            # the regions are gathered here, only the file is written by save
+            header, arrays = measure_morph.get_trait_store()
+            save(trait_store, partial(tc.write_trait_store, header=header, arrays=arrays))
+        
+    if collect:
+        return presence_matrix, measurement, landmark_dict
+
+def read_manifest(manifest_file, require_output=True):
+    '''
+    Read a manifest file (.csv with header or .jsonl) describing one specimen per row.
+    Empty values are ignored. output_presence is optional when require_output is False
+    (outputs saved in consolidated files).
+
+    Returns
+    -------
+    list_task : list of dict
+        DESCRIPTION. keyword arguments for process_specimen()
+
+    '''
+    if manifest_file.endswith('.jsonl'):
+        with open(manifest_file, 'r') as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(manifest_file, 'r', newline='') as f:
+            rows = list(csv.DictReader(f))
+    
+    list_task = []
+    for i, row in enumerate(rows):
+        task = {k: row[k] for k in manifest_columns if row.get(k)}
+        if 'input_image' not in task:
+            raise ValueError(f'{manifest_file} row {i+1}: input_image is required')
+        if require_output and 'output_presence' not in task:
+            raise ValueError(f'{manifest_file} row {i+1}: output_presence is required')
+        list_task.append(task)
+        
+    return list_task
+
+def tasks_from_glob(input_glob, output_dir, metadata_dir=None, save_lm_image=False, save_json=True,
+                    trait_store_dir=None):
+    '''
+    Create the list of tasks for every segmented image matching input_glob.
+    Outputs are named after the base_name (see Segmented_image) in output_dir.
+    save_json: save the json outputs of every specimen, otherwise only the landmark image
+    is saved in output_dir (if save_lm_image)
+    trait_store_dir: save the trait store <base_name>_traits.npz of every specimen in this folder
+    '''
+    list_task = []
+    for input_image in sorted(glob.glob(input_glob)):
+        base_name = tc.get_base_name(input_image)
+        task = {'input_image': input_image}
+        task.update(get_task_outputs(base_name, output_dir, metadata_dir, save_lm_image, save_json, trait_store_dir))
+        list_task.append(task)
+        
+    return list_task
+
+def tasks_from_label_stack(stack_file, output_dir, metadata_dir=None, save_lm_image=False, save_json=True,
+                           trait_store_dir=None):
+    '''
+    Create the list of tasks for every label map of a Label_stack, same outputs as tasks_from_glob()
+    '''
+    list_task = []
+    for base_name in ls.open_label_stack(stack_file).base_names:
+        task = {'input_image': stack_file, 'stack_key': base_name}
+        task.update(get_task_outputs(base_name, output_dir, metadata_dir, save_lm_image, save_json, trait_store_dir))
+        list_task.append(task)
+        
+    return list_task
+
+def get_task_outputs(base_name, output_dir, metadata_dir=None, save_lm_image=False, save_json=True,
+                     trait_store_dir=None):
+    '''
+    Outputs and metadata of the task of the specimen base_name, see tasks_from_glob()
+    '''
+    task = {}
+    if save_json:
+        task.update({'output_presence': os.path.join(output_dir, f'{base_name}_presence.json'),
+                     'morphology': os.path.join(output_dir, f'{base_name}_morphology.json'),
+                     'landmark': os.path.join(output_dir, f'{base_name}_landmark.json')})
+    if metadata_dir:
+        metadata = os.path.join(metadata_dir, f'{base_name}.json')
+        if os.path.isfile(metadata):
+            task['metadata'] = metadata
+    if save_lm_image and output_dir:
+        task['lm_image'] = os.path.join(output_dir, f'{base_name}_lm_image.png')
+    if trait_store_dir:
+        task['trait_store'] = os.path.join(trait_store_dir, f'{base_name}_traits.npz')
+    return task
+
+def add_rulers(list_task, metadata_index):
+    '''
+    Add the ruler (scale, unit) of the metadata index to the tasks without metadata file,
+    the specimen is found by its base_name (stack_key or name of the image)
+    '''
+    for task in list_task:
+        if not task.get('metadata'):
+            base_name = task.get('stack_key') or tc.get_base_name(task['input_image'])
+            ruler = metadata_index.get_ruler(base_name)
+            if ruler:
+                task['ruler'] = ruler
+    return list_task
+
+def run_task(task, options={}):
+    '''
+    Run process_specimen(**task, **options) and catch any error, so a bad image doesn't stop the batch.
+    options are the arguments shared by all the tasks, plus 'profile' to time the stages (see Profiler).
+
+    Returns
+    -------
+    task : dict
+        DESCRIPTION. the task itself
+    output : tuple or None
+        DESCRIPTION. (presence_matrix, measurement, landmark) if options['collect'] is True
+    error : string or None
+        DESCRIPTION. traceback of the error, None if the task succeeded
+    record : dict or None
+        DESCRIPTION. time of the stages if options['profile'] is True (see Profiler.run_profiled)
+
+    '''
+    options = dict(options)
+    profile = options.pop('profile', False)
+    record = None
+    try:
+        if profile:
+            output, record = pf.run_profiled(process_specimen, **task, **options)
+        else:
+            output = process_specimen(**task, **options)
+    except Exception:
+        return task, None, traceback.format_exc(), None
+    return task, output, None, record
+
+def run_chunk(chunk, options={}):
+    '''
+    run_task() on a list of tasks in a worker of run_batch
+    '''
+    return [run_task(task, options) for task in chunk]
+
+def run_batch(list_task, workers=1, chunksize=None, unordered=False, options={}, writer=None, list_record=None):
+    '''
+    Process all the tasks in the current process (workers=1) or in a pool of processes.
+    The tasks are sent to the workers by chunks of chunksize specimens.
+    If a worker is killed (out of memory, segmentation fault...) the pool is broken: the run
+    stops instead of waiting for it, and the tasks without result are reported as failed.
+    options are the arguments of process_specimen shared by all the tasks.
+    writer (Output_writer.Aggregate_writer): the outputs of the workers are collected and
+    streamed in the consolidated files by the main process.
+    list_record (list): the stages are timed and (input_image, record) is appended for every
+    specimen (see Profiler.build_report)
+    
+    Returns
+    -------
+    list_failed : list of tuple
+        DESCRIPTION. (task, error) for every task that raised an error
+
+    '''
+    list_failed = []
+    if writer:
+        options = {**options, 'collect': True}
+    if list_record is not None:
+        options = {**options, 'profile': True}
+    
+    def collect_result(task, output, error, record):
+        if error:
+            list_failed.append((task, error))
+            return
+        if writer:
+            writer.write(*output)
+        if record:
+            list_record.append((task['input_image'], record))
+    
+    if workers > 1 and len(list_task) > 1:
+        if not chunksize:
+            chunksize = max(1, -(-len(list_task) // (workers * 4)))
+        list_chunk = [list_task[i:i + chunksize] for i in range(0, len(list_task), chunksize)]
+        with ProcessPoolExecutor(workers) as executor:
+            futures = {executor.submit(run_chunk, chunk, options): chunk for chunk in list_chunk}
+            for future in (as_completed(futures) if unordered else futures):
+                try:
+                    list_result = future.result()
+                except BrokenProcessPool:
+                    error = 'worker process terminated abruptly (killed, out of memory...), task not processed\n'
+                    list_result = [(task, None, error, None) for task in futures[future]]
+                for result in list_result:
+                    collect_result(*result)
+    else:
+        for task in list_task:
+            collect_result(*run_task(task, options))
+    
+    for task, error in list_failed:
+        print(f"Failed {task['input_image']}\n{error}", file=sys.stderr)
+        
+    return list_failed
+
+def load_specimen(task, with_hash=False):
+    '''
+    Read the files of a task ahead of the analysis (see run_pipeline): the segmented image decoded
+    as a label map (the label map of a stack is copied from the file) and the scale of the metadata.
+    with_hash: also hash the bytes read, for the key of the result cache
+    return the arguments added to the task for process_specimen(): image, ruler, image_hash, metadata_hash
+    '''
+    loaded = {}
+    input_image = task['input_image']
+    if task.get('stack_key') is not None:
+        loaded['image'] = np.array(ls.open_label_stack(input_image)[task['stack_key']])
+    elif not input_image.endswith('.npz'):
+        with open(input_image, 'rb') as f:
+            data = f.read()
+        if with_hash:
+            loaded['image_hash'] = hashlib.sha256(data).hexdigest()
+        loaded['image'] = tc.read_label_map(io.BytesIO(data))
+    
+    if task.get('metadata'):
+        with open(task['metadata'], 'rb') as f:
+            data = f.read()
+        if with_hash:
+            loaded['metadata_hash'] = hashlib.sha256(data).hexdigest()
+        loaded['ruler'] = mi.read_ruler(json.loads(data))
+    return loaded
+
+def run_pipeline(list_task, prefetch=4, options={}, writer=None, list_record=None):
+    '''
+    Process all the tasks in the current process with overlapped I/O, same arguments and
+    return as run_batch(). prefetch threads read and decode the next images (see load_specimen)
+    while the current one is analysed, and a background thread saves the outputs (temporary
+    file + rename) and streams the rows of the consolidated files (see Output_writer.Background_writer).
+    '''
+    list_failed = []
+    options = dict(options)
+    if writer:
+        options['collect'] = True
+    if list_record is not None:
+        options['profile'] = True
+    with_hash = bool(options.get('cache'))
+    
+    with ThreadPoolExecutor(prefetch) as executor, ow.Background_writer() as background:
+        iter_task = iter(list_task)
+        # specimens being read, at most prefetch ahead of the analysis
+        window = deque((task, executor.submit(load_specimen, task, with_hash))
+                       for task in itertools.islice(iter_task, prefetch))
+        while window:
+            task, future = window.popleft()
+            for next_task in itertools.islice(iter_task, 1):
+                window.append((next_task, executor.submit(load_specimen, next_task, with_hash)))
+            try:
+                loaded = future.result()
+            except Exception:
+                list_failed.append((task, traceback.format_exc()))
+                continue
+            
+            save = partial(background.submit, task, ow.save_file)
+            _, output, error, record = run_task({**task, **loaded}, {**options, 'save': save})
+            if error:
+                list_failed.append((task, error))
+                continue
+            if writer:
+                background.submit(task, writer.write, *output)
+            if record:
+                list_record.append((task['input_image'], record))
+    list_failed += background.errors
+    
+    for task, error in list_failed:
+        print(f"Failed {task['input_image']}\n{error}", file=sys.stderr)
+        
+    return list_failed
+
 def main():
     '''
     Use Class Segmented_image, Measure_morphology to extract information 
@@ -82,7 +593,8 @@ def main():
     
     Segmented_image creates an object that isolates different traits, preprocesses them and extract genral info (such as fish angle)
     Measure_morphology inherits from Segmented_image and uses preprocessed traits information to measure morphology
-    characteristic and landmarks.
+    characteristic and landmarks. A single Measure_morphology object feeds every output, so the image is
+    decoded and aligned once.
     There are 4 mains output defined in argument_parser()
     args.output_presence : {"dorsal_fin": {"number": 1, "percentage": 1.0}, "adipos_fin": {"number": 0, "percentage": 0}....}
     number: number of blob per trait, percentage: area % of the bigger blob.
@@ -91,6 +603,21 @@ def main():
     args.landmark : filename to save Coordinate of the landmark extracted.
     args.lm_image : filename to save visualization of the landmarks
     
+    In batch mode (--manifest, --input_glob or --label_stack) the same outputs are saved for every specimen
+    in a single process, or in a pool of --workers processes. A specimen that raises an error is
+    reported and skipped. With --aggregate_dir the outputs of all the specimens are streamed in
+    consolidated files (see Output_writer).
+    With --cache_dir the outputs are stored in a persistent cache and a rerun only processes the
+    specimens that changed (see Result_cache).
+    With --profile the stages of every specimen are timed and a report is saved (see Profiler).
+    With --trait_store (--trait_store_dir) the cleaned regions are saved, a later run on the .npz files
+    calculates the outputs without the images (see Measure_morphology.from_trait_store).
+    With --metadata_index the scales are read from an index of all the metadata (see Metadata_index)
+    instead of one metadata file per specimen.
+    With --prefetch the files of the next specimens are read in threads and the outputs are saved
+    in a background thread, the analysis doesn't wait for the filesystem (see run_pipeline).
+    The outputs are always written in a temporary file renamed when complete.
+    
     Returns
     -------
     None.
@@ -98,56 +625,80 @@ def main():
     '''
     parser = argument_parser()
     args = parser.parse_args()
+    start = time.perf_counter()
+    # records of the stages of every specimen when --profile is used
+    list_record = [] if args.profile else None
     
+    cache = None
+    if args.cache_dir:
+        max_size = args.cache_max_size * 1e6 if args.cache_max_size else None
+        cache = rc.Result_cache(args.cache_dir, max_size=max_size, code_version=get_code_version())
     
-    # Create the image segmentation object
-    img_seg = tc.Segmented_image(args.input_image, align=True)
-    base_name = img_seg.base_name
-    # Create object measure_morphology
-    measure_morph = tc.Measure_morphology(args.input_image, align=True)
-    # Calcualte the mesaurements and landmarks
+    metadata_index = mi.open_metadata_index(args.metadata_index) if args.metadata_index else None
     
-    # Assign variables from img_seg
-    presence_matrix = {'base_name' : base_name, **img_seg.presence_matrix,
-                       'ruler':{'presence' : 'no', 'scale' : 'None', 'unit' : 'None'}}
-    # Assign variable from measure_morph
-    measurements_bbox = measure_morph.measurement_with_bbox
-    measurements_lm = measure_morph.measurement_with_lm
-    measurements_area = measure_morph.measurement_with_area
-    landmark = measure_morph.landmark
-        
-    # Combine the 3 types of measurements (lm, bbox, area) and reorder the keys
-    measurement = {'base_name': base_name, **measurements_bbox, **measurements_lm, **measurements_area }
-    list_measure = ['base_name', 'SL_bbox', 'SL_lm', 'HL_bbox', 'HL_lm', 'pOD_bbox', 'pOD_lm', 'ED_bbox', 'ED_lm', 'HH_lm', 'EA_m','HA_m','FA_pca','FA_lm']
-    measurement = {k:measurement[k] for k in list_measure}
-    measurement.update({'scale':"None", 'unit': "None"})     
+    if args.manifest or args.input_glob or args.label_stack:
+        if (args.input_glob or args.label_stack) and not (args.output_dir or args.aggregate_dir):
+            parser.error('--input_glob and --label_stack require --output_dir or --aggregate_dir')
+        if (args.input_glob or args.label_stack) and args.save_lm_image and not args.output_dir:
+            parser.error('--save_lm_image requires --output_dir, the folder of the landmark images')
+        if args.manifest:
+            list_task = read_manifest(args.manifest, require_output=not args.aggregate_dir)
+        else:
+            if args.output_dir:
+                os.makedirs(args.output_dir, exist_ok=True)
+            tasks_from = tasks_from_glob if args.input_glob else tasks_from_label_stack
+            if args.trait_store_dir:
+                os.makedirs(args.trait_store_dir, exist_ok=True)
+            list_task = tasks_from(args.input_glob or args.label_stack, args.output_dir, args.metadata_dir,
+                                   args.save_lm_image, save_json=not args.aggregate_dir,
+                                   trait_store_dir=args.trait_store_dir)
+        if metadata_index:
+            add_rulers(list_task, metadata_index)
+        options = {'angle_tolerance': args.angle_tolerance, 'cache': cache, 'lm_image_scale': args.lm_image_scale,
+                   'coarse_factor': args.coarse_factor}
+        if args.prefetch:
+            if args.workers > 1:
+                parser.error('--prefetch runs the batch in a single process, use it with --workers 1')
+            run = partial(run_pipeline, list_task, prefetch=args.prefetch, options=options)
+        else:
+            run = partial(run_batch, list_task, workers=args.workers, chunksize=args.chunksize,
+                          unordered=args.unordered, options=options)
+        if args.aggregate_dir:
+            with ow.Aggregate_writer(args.aggregate_dir, args.aggregate_format, json_encoder=NpEncoder) as writer:
+                list_failed = run(writer=writer, list_record=list_record)
+        else:
+            list_failed = run(list_record=list_record)
+        if list_failed:
+            print(f'{len(list_failed)} of {len(list_task)} specimens failed', file=sys.stderr)
+        if args.failed_log:
+            with open(args.failed_log, 'w') as f:
+                for task, error in list_failed:
+                    f.write(json.dumps({**task, 'error': error}) + '\n')
+            
+    elif args.input_image and args.output_presence:
+        kwargs = dict(metadata=args.metadata, morphology=args.morphology, landmark=args.landmark,
+                      lm_image=args.lm_image, angle_tolerance=args.angle_tolerance, cache=cache,
+                      lm_image_scale=args.lm_image_scale, trait_store=args.trait_store,
+                      coarse_factor=args.coarse_factor)
+        if metadata_index and not args.metadata:
+            kwargs['ruler'] = add_rulers([{'input_image': args.input_image}], metadata_index)[0].get('ruler')
+        if args.profile:
+            _, record = pf.run_profiled(process_specimen, args.input_image, args.output_presence, **kwargs)
+            list_record.append((args.input_image, record))
+        else:
+            process_specimen(args.input_image, args.output_presence, **kwargs)
+    else:
+        parser.error('input_image and output_presence are required, unless --manifest, --input_glob or '
+                     '--label_stack is used')
     
-    # Extract the scale from metadata file
-    # and add it to measurement dict
-    if args.metadata:        
-        scale , unit = get_scale(args.metadata)
-        measurement['scale'] = scale
-        measurement['unit'] = unit 
-        
-        presence_matrix['ruler'] = {'presence' : 'yes', 'scale' : scale, 'unit' : unit}                
+    if cache:
+        cache.evict()
     
-    with open(args.output_presence, 'w') as f:
-        json.dump(presence_matrix, f) 
-          
-    # Save the dictionnaries in json file
-    # use NpEncoder to convert the value to correct type (np.int64 -> int)
-    if args.morphology:        
-        with open(args.morphology, 'w') as f:
-            json.dump(measurement, f, cls=NpEncoder)    
-    
-    if args.landmark:
-        with open(args.landmark, 'w') as f:
-            json.dump(landmark, f)
-              
-    if args.lm_image:        
-        # create landmark visualization image and save it
-        img_landmark = measure_morph.visualize_landmark()
-        img_landmark.save(args.lm_image)
+    if args.profile:
+        report = pf.build_report(list_record)
+        report.update({'wall_run': time.perf_counter() - start, 'workers': args.workers})
+        with open(args.profile, 'w') as f:
+            json.dump(report, f, indent=1)
     
     
 if __name__ == '__main__':
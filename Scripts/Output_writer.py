@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Consolidated outputs of the batch mode of Morphology_main.
+
+Instead of 3 small json files per specimen, the rows of all the specimens are streamed
+in one file per table (presence, morphology, landmark) and per format:
+    jsonl   : one json dictionary per line, same content as the json file of a specimen
+    parquet : columnar file, one row group per batch of rows (requires pyarrow)
+    arrow   : Arrow IPC file, one record batch per batch of rows (requires pyarrow)
+
+The outputs of a specimen are saved with save_file (temporary file + rename), and
+Background_writer runs the writes in a thread so the analysis doesn't wait for the filesystem.
+"""
+import os
+import json
+import queue
+import threading
+import traceback
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+list_table = ['presence', 'morphology', 'landmark']
+list_format = ['jsonl', 'parquet', 'arrow']
+# columns saved as string in the columnar formats, the other columns are numbers
+# ('None' values are saved as null)
+string_columns = {'base_name', 'unit', 'ruler.presence', 'ruler.unit'}
+
+
+def flatten_row(row, prefix=''):
+    '''
+    Flatten the nested dictionaries of a row, the keys are joined with "."
+    {"eye": {"number": 1, "percentage": 1.0}} -> {"eye.number": 1, "eye.percentage": 1.0}
+    '''
+    flat_row = {}
+    for key, value in row.items():
+        if isinstance(value, dict):
+            flat_row.update(flatten_row(value, f'{prefix}{key}.'))
+        else:
+            flat_row[f'{prefix}{key}'] = value
+    return flat_row
+
+def get_column_type(table, column):
+    '''
+    Arrow type of a column: string, landmark coordinates [row, col] or number
+    '''
+    if column in string_columns:
+        return pa.string()
+    if table == 'landmark':
+        return pa.list_(pa.int64())
+    return pa.float64()
+
+def to_column_value(value, column_type):
+    '''
+    Convert a value of the json outputs to the type of its column, missing values ('None', []) become None
+    '''
+    if value is None or (isinstance(value, str) and value == 'None') or (isinstance(value, (list, tuple)) and len(value) == 0):
+        return None
+    if column_type == pa.string():
+        return str(value)
+    if column_type == pa.float64():
+        return float(value)
+    return [int(v) for v in value]
+
+
+def save_file(file_name, write):
+    '''
+    Save a file atomically: write(path) writes a temporary file with the same extension in the
+    same folder, renamed to file_name when it is complete, a reader never sees a partial file
+    '''
+    root, ext = os.path.splitext(file_name)
+    tmp_path = f'{root}.tmp{os.getpid()}{ext}'
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, file_name)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class Background_writer():
+    '''
+    Run the writes (function(*args)) in a background thread, in the order they are submitted.
+    At most max_pending writes wait in the queue, submit() blocks when it is full.
+    The errors are collected in errors, list of (name, traceback), name given to submit().
+    Use it as a context manager or call close() to wait for the last writes.
+    '''
+    def __init__(self, max_pending=64):
+
+        self.queue = queue.Queue(max_pending)
+        self.errors = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, name, function, *args):
+        self.queue.put((name, function, args))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            name, function, args = item
+            try:
+                function(*args)
+            except Exception:
+                self.errors.append((name, traceback.format_exc()))
+
+    def close(self):
+        '''
+        Wait until every write is done
+        '''
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+class Aggregate_writer():
+    '''
+    Stream the outputs of many specimens in output_dir/<table>.<format>
+    The columns of a table are the keys of its first row (list_measure order for morphology),
+    base_name is added to the landmark rows.
+    Rows are buffered and written by batches of batch_size rows in the columnar formats.
+    Use it as a context manager or call close() to write the last batch.
+    '''
+    def __init__(self, output_dir, formats=('jsonl',), batch_size=1000, json_encoder=None):
+
+        unknown = set(formats) - set(list_format)
+        if unknown:
+            raise ValueError(f'unknown aggregate format {sorted(unknown)}, expected {list_format}')
+        if pa is None and set(formats) & {'parquet', 'arrow'}:
+            raise ImportError('parquet and arrow formats require pyarrow (pip install pyarrow)')
+
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.formats = formats
+        self.batch_size = batch_size
+        self.json_encoder = json_encoder
+        self.number_row = 0
+
+        self.jsonl_file = {}
+        if 'jsonl' in formats:
+            for table in list_table:
+                self.jsonl_file[table] = open(os.path.join(output_dir, f'{table}.jsonl'), 'w', buffering=1<<20)
+
+        # the columnar writers are created with the first batch, when the columns are known
+        self.schema = {}
+        self.columnar_writer = {table: {} for table in list_table}
+        self.buffer = {table: [] for table in list_table}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, presence, measurement, landmark):
+        '''
+        Add the outputs of one specimen (see Morphology_main.get_morphology)
+        '''
+        base_name = presence['base_name']
+        rows = {'presence': presence,
+                'morphology': measurement,
+                'landmark': {'base_name': base_name, **landmark}}
+
+        for table, row in rows.items():
+            if table in self.jsonl_file:
+                self.jsonl_file[table].write(json.dumps(row, cls=self.json_encoder) + '\n')
+            if set(self.formats) & {'parquet', 'arrow'}:
+                self.buffer[table].append(flatten_row(row))
+                if len(self.buffer[table]) >= self.batch_size:
+                    self.write_batch(table)
+        self.number_row += 1
+
+    def write_batch(self, table):
+        '''
+        Write the buffered rows of table in the columnar files
+        '''
+        rows = self.buffer[table]
+        if not rows:
+            return
+        if table not in self.schema:
+            self.schema[table] = pa.schema([(column, get_column_type(table, column)) for column in rows[0]])
+        schema = self.schema[table]
+
+        columns = [[to_column_value(row.get(field.name), field.type) for row in rows] for field in schema]
+        batch = pa.RecordBatch.from_arrays([pa.array(c, type=field.type) for c, field in zip(columns, schema)],
+                                           schema=schema)
+
+        writer = self.columnar_writer[table]
+        if 'parquet' in self.formats:
+            if 'parquet' not in writer:
+                writer['parquet'] = pq.ParquetWriter(os.path.join(self.output_dir, f'{table}.parquet'), schema)
+            writer['parquet'].write_batch(batch)
+        if 'arrow' in self.formats:
+            if 'arrow' not in writer:
+                writer['arrow'] = pa.ipc.new_file(os.path.join(self.output_dir, f'{table}.arrow'), schema)
+            writer['arrow'].write_batch(batch)
+        self.buffer[table] = []
+
+    def close(self):
+        '''
+        Write the last batch and close all the files
+        '''
+        for table in list_table:
+            if set(self.formats) & {'parquet', 'arrow'}:
+                self.write_batch(table)
+            for writer in self.columnar_writer[table].values():
+                writer.close()
+            self.columnar_writer[table] = {}
+        for f in self.jsonl_file.values():
+            f.close()
+        self.jsonl_file = {}
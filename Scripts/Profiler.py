@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing of the morphology pipeline.
+
+The stages are the methods decorated with @profiled(stage_name) (import_image,
+get_fish_angle_pca, align_fish...) and the blocks "with stage(stage_name):".
+When no profiler is active (default) a stage only costs a test of the global
+variable active. run_profiled() activates a Stage_profiler for one specimen
+and returns its record, build_report() aggregates the records of a batch.
+Only the stages of the thread running the specimen are recorded, not the
+ones of the prefetch and writer threads of the batch pipeline.
+
+Times are inclusive: a stage running inside another stage is counted in both.
+
+Memory: on linux the peak resident memory (VmHWM) is reset at the start of every
+specimen (/proc/self/clear_refs), a stage records the peak of the specimen so far
+(peak_rss_mb, the stage total is the peak of the specimen). Elsewhere only the
+high-water mark of the process since it started is available (process_max_rss_mb).
+"""
+import time
+import functools
+import threading
+from contextlib import contextmanager, nullcontext
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, the memory is not reported
+    resource = None
+
+# Stage_profiler collecting the stages of the current specimen, None when the profiling is off
+active = None
+
+# edges of the histograms of the stage times (second), the same for every report to compare runs
+histogram_edges = np.concatenate([[0], np.geomspace(1e-5, 1e3, 33)])
+
+
+def get_max_rss():
+    '''
+    High-water mark of the resident memory of the process since it started (MB), None if it is not available.
+    It is not the memory of one specimen: in a batch it is the peak of all the specimens processed so far by the worker.
+    '''
+    if resource is None:
+        return None
+    # ru_maxrss is in kB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss():
+    '''
+    Reset the peak resident memory of the process (linux), return False if it is not possible
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def get_peak_rss():
+    '''
+    Peak resident memory of the process since the last reset_peak_rss() (MB), None if it is not available
+    '''
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    # value in kB
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class Stage_profiler():
+    '''
+    Collect the number of calls, wall time and cpu time of every stage and the
+    peak memory at the end of every stage: peak of the specimen (peak_rss_mb) when the peak
+    of the process can be reset, else high-water mark of the process (process_max_rss_mb).
+    '''
+    def __init__(self):
+        self.stages = {}
+        self.thread = threading.get_ident()
+        if reset_peak_rss() and get_peak_rss() is not None:
+            self.memory_key, self.get_memory = 'peak_rss_mb', get_peak_rss
+        else:
+            self.memory_key, self.get_memory = 'process_max_rss_mb', get_max_rss
+
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, self.memory_key: None})
+            record['calls'] += 1
+            record['wall'] += time.perf_counter() - wall
+            record['cpu'] += time.process_time() - cpu
+            record[self.memory_key] = self.get_memory()
+
+
+def stage(name):
+    '''
+    Context manager timing its block as stage name when the profiling is on
+    '''
+    if active is None or active.thread != threading.get_ident():
+        return nullcontext()
+    return active.stage(name)
+
+def profiled(name):
+    '''
+    Decorator timing every call of the function as stage name when the profiling is on
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if active is None or active.thread != threading.get_ident():
+                return function(*args, **kwargs)
+            with active.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def run_profiled(function, *args, **kwargs):
+    '''
+    Run function(*args, **kwargs) with a new active Stage_profiler, the whole call is the stage "total"
+    return result, record {stage_name: {'calls', 'wall', 'cpu', 'peak_rss_mb' or 'process_max_rss_mb'}}
+    '''
+    global active
+    profiler = active = Stage_profiler()
+    try:
+        with profiler.stage('total'):
+            result = function(*args, **kwargs)
+    finally:
+        active = None
+    return result, profiler.stages
+
+def build_report(list_record):
+    '''
+    Aggregate the records of the specimens (list of (name, record) with the record of run_profiled)
+    For every stage: number of specimens and calls, total, mean, percentiles and histogram
+    of the wall time per specimen, total cpu time, largest and median peak memory of the specimens
+    (peak_rss_mb) or high-water mark of the processes (process_max_rss_mb).
+    '''
+    report = {'number_specimen': len(list_record), 'histogram_edges': histogram_edges.tolist(), 'stages': {}}
+
+    list_stage = []
+    for _, record in list_record:
+        list_stage += [s for s in record if s not in list_stage]
+
+    for name in list_stage:
+        stage_records = [record[name] for _, record in list_record if name in record]
+        wall = np.array([r['wall'] for r in stage_records])
+        cpu = np.array([r['cpu'] for r in stage_records])
+        report['stages'][name] = {
+            'number_specimen': len(stage_records),
+            'calls': sum(r['calls'] for r in stage_records),
+            'wall_total': float(wall.sum()),
+            'wall_mean': float(wall.mean()),
+            'wall_p50': float(np.percentile(wall, 50)),
+            'wall_p95': float(np.percentile(wall, 95)),
+            'wall_max': float(wall.max()),
+            'cpu_total': float(cpu.sum()),
+            'wall_histogram': np.histogram(wall, histogram_edges)[0].tolist()}
+        list_peak = [r['peak_rss_mb'] for r in stage_records if r.get('peak_rss_mb') is not None]
+        if list_peak:
+            report['stages'][name]['peak_rss_mb'] = max(list_peak)
+            report['stages'][name]['peak_rss_mb_p50'] = float(np.percentile(list_peak, 50))
+        list_rss = [r['process_max_rss_mb'] for r in stage_records if r.get('process_max_rss_mb') is not None]
+        if list_rss:
+            report['stages'][name]['process_max_rss_mb'] = max(list_rss)
+
+    report['specimens'] = [{'name': name, 'stages': record} for name, record in list_record]
+    return report
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Regression check of the outputs of the morphology pipeline (presence, morphology, landmark).
+
+golden mode (default): run Morphology_main.get_morphology on every segmented image of a
+corpus and compare the outputs with the golden json files stored next to it
+<base_name>_presence.json, <base_name>_morphology.json, <base_name>_landmark.json
+(Test_Data/INHS_FISH_000742_*.json by default). --update writes the golden files
+from the current code.
+
+reference mode (--reference path/to/Traits_class.py): run a reference version of
+Traits_class (i.e. the legacy engine extracted with git show) and the current one
+on the same images and compare them side by side.
+    git show <commit>:Scripts/Traits_class.py > /tmp/Traits_reference.py
+    Regression_check.py --input_glob "Segmented/*_segmented.png" --reference /tmp/Traits_reference.py
+
+The numbers are compared with a tolerance per field, chosen by the last matching pattern
+(fnmatch) of default_tolerance and --tolerance. The fields are named <table>.<key>,
+i.e. morphology.SL_lm, presence.eye.percentage, landmark.5 (both coordinates).
+The script exits with status 1 when a difference is found.
+"""
+import os
+import sys
+import glob
+import json
+import fnmatch
+import argparse
+import traceback
+import importlib.util
+import Traits_class as tc
+import Morphology_main as mm
+
+list_table = ['presence', 'morphology', 'landmark']
+# exact match by default, use --tolerance to relax a field i.e "landmark.*=1" "morphology.FA_pca=0.05"
+default_tolerance = {'*': 0}
+test_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Test_Data')
+
+
+def load_engine(file_name, module_name='Traits_reference'):
+    '''
+    Import a version of Traits_class from its file
+    '''
+    spec = importlib.util.spec_from_file_location(module_name, file_name)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def normalize(outputs):
+    '''
+    Convert the outputs to plain json types (np.int64 -> int, tuple -> list)
+    '''
+    return json.loads(json.dumps(outputs, cls=mm.NpEncoder))
+
+def get_outputs(input_image, metadata=None):
+    '''
+    Outputs of the current code, as saved by Morphology_main
+    '''
+    _, presence_matrix, measurement, landmark = mm.get_morphology(input_image, metadata)
+    return normalize({'presence': presence_matrix, 'morphology': measurement, 'landmark': landmark})
+
+def get_reference_outputs(engine, input_image, metadata=None):
+    '''
+    Outputs of a reference Traits_class (engine), built from the attributes shared by
+    every version (presence_matrix, landmark, measurement_with_bbox/lm/area) as the
+    original Morphology_main did
+    '''
+    measure_morph = engine.Measure_morphology(input_image, align=True)
+    base_name = measure_morph.base_name
+    presence_matrix = {'base_name': base_name, **measure_morph.presence_matrix,
+                       'ruler': {'presence': 'no', 'scale': 'None', 'unit': 'None'}}
+    measurement = {'base_name': base_name, **measure_morph.measurement_with_bbox,
+                   **measure_morph.measurement_with_lm, **measure_morph.measurement_with_area}
+    measurement = {k: measurement[k] for k in mm.list_measure}
+    measurement.update({'scale': 'None', 'unit': 'None'})
+    if metadata:
+        scale, unit = mm.get_scale(metadata)
+        measurement.update({'scale': scale, 'unit': unit})
+        presence_matrix['ruler'] = {'presence': 'yes', 'scale': scale, 'unit': unit}
+    return normalize({'presence': presence_matrix, 'morphology': measurement, 'landmark': measure_morph.landmark})
+
+def get_tolerance(field, tolerance):
+    '''
+    Tolerance of the last pattern matching field
+    '''
+    value = 0
+    for pattern, pattern_value in tolerance.items():
+        if fnmatch.fnmatchcase(field, pattern):
+            value = pattern_value
+    return value
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def compare(field, expected, actual, tolerance):
+    '''
+    Compare expected and actual (json values) recursively
+    return list of differences (field, expected, actual)
+    '''
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        list_diff = []
+        for key in list(expected) + [k for k in actual if k not in expected]:
+            if key not in expected or key not in actual:
+                list_diff.append((f'{field}.{key}', expected.get(key, 'missing'), actual.get(key, 'missing')))
+            else:
+                list_diff += compare(f'{field}.{key}', expected[key], actual[key], tolerance)
+        return list_diff
+
+    if isinstance(expected, list) and isinstance(actual, list) and len(expected) == len(actual):
+        # coordinates of a landmark, the same tolerance for all the elements
+        if all(not compare(field, e, a, tolerance) for e, a in zip(expected, actual)):
+            return []
+        return [(field, expected, actual)]
+
+    if is_number(expected) and is_number(actual):
+        if abs(expected - actual) <= get_tolerance(field, tolerance):
+            return []
+        return [(field, expected, actual)]
+
+    return [] if expected == actual else [(field, expected, actual)]
+
+def get_metadata(input_image, metadata_dir):
+    '''
+    Metadata file <base_name>.json in metadata_dir, None if it doesn't exist
+    '''
+    base_name = tc.get_base_name(input_image)
+    metadata = os.path.join(metadata_dir or os.path.dirname(input_image), f'{base_name}.json')
+    return metadata if os.path.isfile(metadata) else None
+
+def check_golden(input_image, golden_dir, metadata_dir, tolerance, update=False):
+    '''
+    Compare the outputs of input_image with its golden files (or write them if update)
+    return list of differences
+    '''
+    base_name = tc.get_base_name(input_image)
+    golden_dir = golden_dir or os.path.dirname(input_image)
+    outputs = get_outputs(input_image, get_metadata(input_image, metadata_dir))
+
+    list_diff = []
+    for table in list_table:
+        golden_file = os.path.join(golden_dir, f'{base_name}_{table}.json')
+        if update:
+            with open(golden_file, 'w') as f:
+                json.dump(outputs[table], f)
+        elif not os.path.isfile(golden_file):
+            list_diff.append((table, 'golden file', 'missing'))
+        else:
+            with open(golden_file, 'r') as f:
+                list_diff += compare(table, json.load(f), outputs[table], tolerance)
+    return list_diff
+
+def check_reference(input_image, engine, metadata_dir, tolerance):
+    '''
+    Compare the outputs of the reference engine (expected) and the current code (actual)
+    return list of differences
+    '''
+    metadata = get_metadata(input_image, metadata_dir)
+    expected = get_reference_outputs(engine, input_image, metadata)
+    actual = get_outputs(input_image, metadata)
+    list_diff = []
+    for table in list_table:
+        list_diff += compare(table, expected[table], actual[table], tolerance)
+    return list_diff
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Compare the presence, morphology and landmark outputs with golden '
+                                     'files or with a reference version of Traits_class.')
+    parser.add_argument('--input_glob', default=os.path.join(test_data_dir, '*_segmented.png'),
+                        help='Glob pattern of the segmented images (default Test_Data/*_segmented.png).')
+    parser.add_argument('--golden_dir',
+                        help='Folder of the golden files <base_name>_<table>.json (default the folder of the image).')
+    parser.add_argument('--metadata_dir',
+                        help='Folder of the metadata files <base_name>.json (default the folder of the image).')
+    parser.add_argument('--update', action='store_true', help='Write the golden files from the current code.')
+    parser.add_argument('--reference',
+                        help='Path of a reference Traits_class.py, compared side by side with the current code.')
+    parser.add_argument('--tolerance', action='append', default=[], metavar='FIELD=VALUE',
+                        help='Absolute tolerance of the fields matching the pattern, i.e "landmark.*=1", '
+                        '"presence.*.percentage=1e-6". Can be repeated, the last matching pattern is used.')
+    parser.add_argument('--report', help='Save the differences. Format JSON file.')
+    return parser
+
+def main():
+    parser = argument_parser()
+    args = parser.parse_args()
+
+    tolerance = dict(default_tolerance)
+    for item in args.tolerance:
+        pattern, _, value = item.partition('=')
+        try:
+            tolerance[pattern] = float(value)
+        except ValueError:
+            parser.error(f'--tolerance expects FIELD=VALUE, got {item}')
+
+    list_image = sorted(glob.glob(args.input_glob))
+    if not list_image:
+        parser.error(f'no image matches {args.input_glob}')
+    engine = load_engine(args.reference) if args.reference else None
+
+    report = {}
+    for input_image in list_image:
+        try:
+            if engine:
+                list_diff = check_reference(input_image, engine, args.metadata_dir, tolerance)
+            else:
+                list_diff = check_golden(input_image, args.golden_dir, args.metadata_dir, tolerance, args.update)
+        except Exception:
+            list_diff = [('error', None, traceback.format_exc())]
+        if list_diff:
+            report[input_image] = [{'field': f, 'expected': e, 'actual': a} for f, e, a in list_diff]
+            for field, expected, actual in list_diff:
+                print(f'{input_image} {field}: expected {expected} got {actual}')
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    if args.update:
+        print(f'golden files of {len(list_image) - len(report)} specimens updated')
+    else:
+        print(f'{len(report)} of {len(list_image)} specimens different')
+    if report:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of the outputs of Morphology_main (presence, measurements, landmarks).
+
+An entry is identified by the hash of everything the outputs depend on:
+the bytes and the file name (base_name) of the segmented image, the bytes of the
+metadata file, the parameters (align, cutoff...) and the version of the code.
+Rerunning a batch only processes the specimens whose entry is missing.
+
+Entries are small json files cache_dir/<2 first characters>/<key>.json, written
+atomically (temporary file + rename) so several workers can share the cache.
+The last access time of an entry is its modification time, used to evict the
+least recently used entries when the cache is bigger than max_size.
+"""
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+
+def hash_file(file_name, chunk_size=1<<20):
+    '''
+    sha256 of the content of a file
+    '''
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Result_cache():
+    '''
+    Cache of the outputs (presence_matrix, measurement, landmark) of a specimen
+    cache_dir : folder of the cache, created if needed
+    max_size : maximum size of the cache in bytes, None for no limit (see evict)
+    code_version : string that changes when the code producing the outputs changes
+    When a put() makes the cache bigger than max_size, the least recently used entries are removed
+    down to evict_ratio * max_size, so a long or interrupted run doesn't exceed the limit.
+    The size is counted from the last scan of the folder plus the entries written by this
+    instance, with several worker processes the cache can exceed max_size by the entries
+    written by the other workers since their last scan.
+    '''
+    evict_ratio = 0.9
+
+    def __init__(self, cache_dir, max_size=None, code_version=''):
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.code_version = code_version
+        # size of the cache (bytes) known by this instance, None until the folder is scanned
+        self.size = None
+
+    def get_key(self, input_image, metadata=None, parameters={}, base_name=None, image_hash=None, metadata_hash=None):
+        '''
+        Hash of the image, metadata file, parameters (dictionary) and code version
+        The file name of the image is part of the key, the outputs contain its base_name
+        input_image can also be a label map (np.ndarray) with its base_name (see Label_stack)
+        image_hash, metadata_hash: hash_file() of the files when it is already known (the file is not read)
+        '''
+        digest = hashlib.sha256()
+        digest.update(self.code_version.encode())
+        if isinstance(input_image, str):
+            digest.update(os.path.basename(input_image).encode())
+            digest.update((image_hash or hash_file(input_image)).encode())
+        else:
+            digest.update(f'label map {base_name} {input_image.shape}'.encode())
+            digest.update(hashlib.sha256(np.ascontiguousarray(input_image)).hexdigest().encode())
+        digest.update((metadata_hash or hash_file(metadata)).encode() if metadata else b'no metadata')
+        digest.update(json.dumps(parameters, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def get(self, key):
+        '''
+        Return the outputs (presence_matrix, measurement, landmark) stored with key,
+        None if the entry doesn't exist
+        '''
+        path = self.get_path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # mark the entry as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry['presence'], entry['measurement'], entry['landmark']
+
+    def put(self, key, output, json_encoder=None):
+        '''
+        Store the outputs (presence_matrix, measurement, landmark) with key
+        '''
+        presence, measurement, landmark = output
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write in a temporary file and rename it, a reader never sees a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'presence': presence, 'measurement': measurement, 'landmark': landmark},
+                          f, cls=json_encoder)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        if self.max_size is not None:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self.list_entry())
+            else:
+                self.size += os.path.getsize(path)
+            if self.size > self.max_size:
+                self.evict(self.evict_ratio * self.max_size)
+
+    def list_entry(self):
+        '''
+        (modification time, size, path) of every entry of the cache
+        '''
+        list_entry = []
+        for folder, _, files in os.walk(self.cache_dir):
+            for file_name in files:
+                if file_name.endswith('.json'):
+                    path = os.path.join(folder, file_name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        # removed by another process
+                        continue
+                    list_entry.append((stat.st_mtime, stat.st_size, path))
+        return list_entry
+
+    def evict(self, target_size=None):
+        '''
+        Remove the least recently used entries until the cache is smaller than target_size (default max_size)
+        return the number of entries removed
+        '''
+        if self.max_size is None:
+            return 0
+        if target_size is None:
+            target_size = self.max_size
+
+        list_entry = self.list_entry()
+        total_size = sum(size for _, size, _ in list_entry)
+        number_removed = 0
+        for _, size, path in sorted(list_entry):
+            if total_size <= target_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            number_removed += 1
+
+        self.size = total_size
+        return number_removed
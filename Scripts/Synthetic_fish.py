@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Generator of synthetic segmented fish, painted with the colors of Traits_class.trait_color_dict.
+
+The fish is made of ellipses and polygons (trunk, head, eye, dorsal, caudal, anal,
+pelvic and pectoral fins) laid out like a minnow facing left, scaled to the size of
+the image. Options add the defects found in real segmentations: holes in the traits,
+small fragments, missing traits (eye...), rotated body.
+Used by Benchmark_morphology.py, or from the command line to create a corpus:
+    Synthetic_fish.py output_dir --number 10 --width 800 --height 320
+"""
+import os
+import argparse
+import numpy as np
+from PIL import Image, ImageDraw
+from Traits_class import trait_color_dict
+
+# layout of the traits in a 800x320 image, scaled to the requested size
+# ellipses: bounding box (left, top, right, bottom), polygons: list of (x, y)
+fish_layout = {'dorsal_fin': ('polygon', [(300, 112), (390, 35), (470, 50), (440, 105)]),
+               'caudal_fin': ('polygon', [(595, 170), (735, 60), (700, 170), (735, 280)]),
+               'anal_fin': ('polygon', [(470, 228), (545, 292), (570, 222)]),
+               'pelvic_fin': ('polygon', [(330, 238), (375, 298), (400, 243)]),
+               'trunk': ('ellipse', (150, 95, 640, 245)),
+               'head': ('ellipse', (40, 100, 230, 240)),
+               'pectoral_fin': ('polygon', [(190, 195), (275, 262), (245, 195)]),
+               'eye': ('ellipse', (82, 132, 118, 168))}
+
+
+def scale_shape(shape, scale_x, scale_y, dx=0, dy=0):
+    '''
+    Scale and translate a shape of fish_layout
+    '''
+    kind, coords = shape
+    if kind == 'ellipse':
+        left, top, right, bottom = coords
+        return kind, (left*scale_x + dx, top*scale_y + dy, right*scale_x + dx, bottom*scale_y + dy)
+    return kind, [(x*scale_x + dx, y*scale_y + dy) for x, y in coords]
+
+def draw_shape(draw, shape, color):
+    kind, coords = shape
+    if kind == 'ellipse':
+        draw.ellipse(coords, fill=color)
+    else:
+        draw.polygon(coords, fill=color)
+
+def make_synthetic_fish(width=800, height=320, angle=0, holes=0, fragments=0, missing_traits=(), seed=0):
+    '''
+    Create a segmented fish image (RGB np.array uint8 height x width x 3)
+
+    width, height : size of the image, the fish is scaled to fill it
+    angle : rotation of the fish (degree, counterclockwise)
+    holes : number of background holes in the trunk and the head
+    fragments : number of small isolated blobs of trunk and fins
+    missing_traits : traits not painted, i.e ('eye',)
+    seed : the size and position of the fish, holes and fragments vary with the seed
+    '''
+    rng = np.random.default_rng(seed)
+    scale_x = width / 800 * rng.uniform(0.95, 1)
+    scale_y = height / 320 * rng.uniform(0.95, 1)
+    dx = rng.uniform(0, width - 800*scale_x + 1e-9)
+    dy = rng.uniform(0, height - 320*scale_y + 1e-9)
+
+    img = Image.new('RGB', (width, height), tuple(trait_color_dict['background']))
+    draw = ImageDraw.Draw(img)
+
+    for trait, shape in fish_layout.items():
+        if trait not in missing_traits:
+            draw_shape(draw, scale_shape(shape, scale_x, scale_y, dx, dy), tuple(trait_color_dict[trait]))
+
+    background = tuple(trait_color_dict['background'])
+    for _ in range(holes):
+        # small hole inside the trunk or the head
+        trait = rng.choice(['trunk', 'head'])
+        left, top, right, bottom = scale_shape(fish_layout[trait], scale_x, scale_y, dx, dy)[1]
+        cx, cy = rng.uniform(0.3, 0.7)*(right-left) + left, rng.uniform(0.35, 0.65)*(bottom-top) + top
+        r = 0.02 * (bottom-top)
+        draw.ellipse((cx-r, cy-r, cx+r, cy+r), fill=background)
+
+    for _ in range(fragments):
+        # small blob in the empty space around the fish
+        trait = rng.choice(['trunk', 'dorsal_fin', 'caudal_fin', 'anal_fin'])
+        cx, cy = rng.uniform(0.1, 0.9)*width, rng.choice([rng.uniform(0.01, 0.08), rng.uniform(0.92, 0.99)])*height
+        r = 0.01 * height
+        draw.ellipse((cx-r, cy-r, cx+r, cy+r), fill=tuple(trait_color_dict[trait]))
+
+    if angle:
+        # nearest neighbour keeps only the colors of the traits
+        img = img.rotate(angle, resample=Image.NEAREST, fillcolor=background)
+
+    return np.array(img)
+
+def save_synthetic_fish(file_name, **kwargs):
+    '''
+    Create a synthetic fish (see make_synthetic_fish) and save it as a png
+    file_name should be formated "Unique_identifier_segmented.png" like the real segmented images
+    '''
+    Image.fromarray(make_synthetic_fish(**kwargs)).save(file_name)
+    return file_name
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Create synthetic segmented fish images (PNG) with the colors '
+                                     'of Traits_class.')
+    parser.add_argument('output_dir', help='Folder of the images, named SYNTHETIC_<number>_segmented.png.')
+    parser.add_argument('--number', type=int, default=1, help='Number of images (default 1).')
+    parser.add_argument('--width', type=int, default=800, help='Width of the images (default 800).')
+    parser.add_argument('--height', type=int, default=320, help='Height of the images (default 320).')
+    parser.add_argument('--max_angle', type=float, default=0,
+                        help='The fish is rotated by a random angle between -max_angle and max_angle (degree).')
+    parser.add_argument('--holes', type=int, default=0, help='Number of holes in the trunk and head.')
+    parser.add_argument('--fragments', type=int, default=0, help='Number of small isolated blobs.')
+    parser.add_argument('--missing', nargs='*', default=[], help='Traits not painted, i.e eye adipos_fin.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the first image.')
+    return parser
+
+def main():
+    args = argument_parser().parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    rng = np.random.default_rng(args.seed)
+    for i in range(args.number):
+        angle = rng.uniform(-args.max_angle, args.max_angle) if args.max_angle else 0
+        file_name = os.path.join(args.output_dir, f'SYNTHETIC_{args.seed + i:06d}_segmented.png')
+        save_synthetic_fish(file_name, width=args.width, height=args.height, angle=angle, holes=args.holes,
+                            fragments=args.fragments, missing_traits=args.missing, seed=args.seed + i)
+
+if __name__ == '__main__':
+    main()
@@ -23,39 +23,429 @@
 
 import os, sys, math, json
 from operator import sub
+from functools import cached_property
+from collections.abc import Mapping
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
-from skimage.measure import label, regionprops
-from skimage.morphology import reconstruction
+from scipy import ndimage
+from skimage.measure import label
+from Profiler import profiled
+
+
+# color of each trait in the segmented images
+trait_color_dict = {'background': [0, 0, 0],'dorsal_fin': [254, 0, 0],'adipos_fin': [0, 254, 0],
+                    'caudal_fin': [0, 0, 254],'anal_fin': [254, 254, 0],'pelvic_fin': [0, 254, 254],
+                    'pectoral_fin': [254, 0, 254],'head': [254, 254, 254],'eye': [0, 254, 102],
+                    'caudal_fin_ray': [254, 102, 102],'alt_fin_ray': [254, 102, 204],
+                    'trunk': [0, 124, 124]}
+
+
+def get_base_name(file_name):
+    '''
+    Unique identifier of a specimen from the name of one of its files
+    expected name format "Unique_identifier_segmented.png" i.e "INHS_FISH_00072_segmented.png"
+    '''
+    return os.path.split(file_name)[1].rsplit('_', 1)[0]
+
+def color_lookup(trait_color_dict):
+    '''
+    Create the lookup tables used to convert a RGB color to its trait index in one pass.
+    The trait index is the position of the trait in trait_color_dict (background is 0).
+    Every value used in a channel by trait_color_dict gets a digit (1 to n, 0 for any other value).
+    The 3 digits are packed in a code = digit_r*(n+1)**2 + digit_g*(n+1) + digit_b,
+    np.uint8 when (n+1)**3 <= 256 (5 values per channel, the default colors), np.uint16 up to
+    39 values per channel, ValueError above.
+    
+    output
+    channel_lut : list of 3 arrays (256,) value of the channel -> contribution to the code
+    code_lut : array ((n+1)**3,) code -> trait index, 0 (background) for unknown color
+    '''
+    colors = np.array(list(trait_color_dict.values()))
+    levels = np.unique(colors)
+    base = len(levels) + 1
+    if base**3 <= 256:
+        dtype = np.uint8
+    elif base**3 <= 65536:
+        dtype = np.uint16
+    else:
+        raise ValueError(f'trait_color_dict uses {len(levels)} values per channel, the maximum is 39')
+    
+    digit = np.zeros(256, dtype=np.int64)
+    digit[levels] = np.arange(1, base)
+    channel_lut = [(digit * base**2).astype(dtype), (digit * base).astype(dtype), digit.astype(dtype)]
+    
+    code_lut = np.zeros(base**3, dtype=np.uint8)
+    for index, color in enumerate(trait_color_dict.values()):
+        code = sum(int(lut[value]) for lut, value in zip(channel_lut, color))
+        code_lut[code] = index
+        
+    return channel_lut, code_lut
+
+@profiled('get_label_map')
+def rgb_to_label_map(img, trait_color_dict=trait_color_dict):
+    '''
+    Convert a RGB(A) image (numpy.ndarray, np.uint8) (320, 800, 3)
+    to a label map (320, 800) np.uint8 with the trait index of every pixel, a color
+    not in trait_color_dict is background (0)
+    '''
+    channel_lut, code_lut = color_lookup(trait_color_dict)
+    code = np.take(channel_lut[0], img[:, :, 0])
+    code += np.take(channel_lut[1], img[:, :, 1])
+    code += np.take(channel_lut[2], img[:, :, 2])
+    
+    return np.take(code_lut, code)
+
+@profiled('import_image')
+def read_label_map(file_name, trait_color_dict=trait_color_dict):
+    '''
+    Read a segmented image directly as a label map (trait index of every pixel, np.uint8)
+    + RGB(A) png: colors of trait_color_dict, any other color is background
+    + palette png (mode P): only the colors of the palette are converted, the pixels are
+      palette indexes, no RGB image is created
+    + single channel png (mode L, I;16, I) or 2D npy: the value of the pixel is the trait
+      index, any other value is background
+    + 3D npy: RGB image
+    file_name can also be a binary file object (i.e io.BytesIO of the bytes already read)
+    '''
+    number_trait = len(trait_color_dict)
+    if isinstance(file_name, str):
+        is_npy = file_name.endswith('.npy')
+    else:
+        is_npy = file_name.read(6) == b'\x93NUMPY'
+        file_name.seek(0)
+    if is_npy:
+        img = np.load(file_name)
+        if img.ndim == 3:
+            return rgb_to_label_map(img, trait_color_dict)
+    else:
+        img = Image.open(file_name)
+        if img.mode == 'P':
+            palette = np.array(img.getpalette(), dtype=np.uint8).reshape(1, -1, 3)
+            palette_lut = np.zeros(256, dtype=np.uint8)
+            palette_lut[:palette.shape[1]] = rgb_to_label_map(palette, trait_color_dict)[0]
+            return np.take(palette_lut, np.asarray(img))
+        if img.mode not in ('L', 'I;16', 'I'):
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGB')
+            return rgb_to_label_map(np.asarray(img), trait_color_dict)
+        img = np.asarray(img)
+    
+    # label image, trait index
+    if img.dtype == np.uint8 and img.max(initial=0) < number_trait:
+        return np.array(img)
+    return np.where((img >= 0) & (img < number_trait), img, 0).astype(np.uint8)
+
+def write_label_map(label_map, file_name, trait_color_dict=trait_color_dict):
+    '''
+    Save a label map in a compact form, read back by read_label_map
+    + .npy: the label map (np.uint8)
+    + other extension (.png): palette image, one byte per pixel, displayed with the colors of trait_color_dict
+    '''
+    label_map = np.asarray(label_map, dtype=np.uint8)
+    if file_name.endswith('.npy'):
+        np.save(file_name, label_map)
+    else:
+        img = Image.fromarray(label_map)
+        img.putpalette([value for color in trait_color_dict.values() for value in color])
+        img.save(file_name)
+
+
+def write_trait_store(file_name, header, arrays):
+    '''
+    Save a trait store, see Segmented_image.get_trait_store()
+    '''
+    with open(file_name, 'wb') as f:
+        np.savez_compressed(f, header=np.array(json.dumps(header)), **arrays)
+
+@profiled('draw_landmark')
+def draw_landmark(label_map, landmark, scale=1, trait_color_dict=trait_color_dict):
+    '''
+    Draw the landmarks {"1": [row, col], ...} (number in a gray disk) on the segmented image
+    created from the label map. The colors are applied with a palette (mode P) and the image is
+    converted to RGB, the format of the landmark images, before drawing.
+    scale: size of the image relative to the label map (i.e 0.5), the disks keep their size
+    '''
+    img = Image.fromarray(np.asarray(label_map, dtype=np.uint8))
+    if scale != 1:
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        img = img.resize(size, Image.NEAREST)
+    img.putpalette([value for color in trait_color_dict.values() for value in color])
+    img = img.convert('RGB')
+    
+    draw = ImageDraw.Draw(img)
+    #fnt = ImageFont.truetype("Pillow/Tests/fonts/FreeMono.ttf", 15)
+    fnt = ImageFont.load_default()
+    for k, v in landmark.items():
+        # landmark exist draw it on the image
+        if v:
+            row, col = v[0] * scale, v[1] * scale
+            draw.ellipse([(col-9, row-9), (col+9, row+9)], fill=(128, 128, 128))
+            draw.text((col-6, row-6), k, font=fnt, fill=(0, 0, 0))
+    return img
+
+
+class Trait_masks(Mapping):
+    '''
+    Dictionary like access to the binary mask (uint8) of each trait of a label map.
+    The mask is created when it is requested from the label map and is not kept in memory.
+    '''
+    
+    def __init__(self, label_map, trait_index):
+        self.label_map = label_map
+        self.trait_index = trait_index # {trait_name: value in label_map}
+        
+    def __getitem__(self, trait_name):
+        # bool and uint8 have the same size, view() avoids a copy
+        return (self.label_map == self.trait_index[trait_name]).view(np.uint8)
+    
+    def __iter__(self):
+        return iter(self.trait_index)
+    
+    def __len__(self):
+        return len(self.trait_index)
+
+
+def get_component_stats(label_image, number=None, properties=("area", "bbox", "centroid", "moments")):
+    '''
+    Statistics of the components (value 1 to number) of a label image, computed for all
+    the components at once with np.bincount over the labeled pixels
+    (bbox uses scipy.ndimage.find_objects).
+    
+    return dictionary of arrays indexed by the label value (index 0 is the background) with the
+    requested properties
+        "area" : number of pixels
+        "bbox" : (min_row, min_col, max_row, max_col), max excluded like regionprops
+        "centroid" : (row, col)
+        "moments" : central moments of order 2 (mu_rr, mu_rc, mu_cc)
+    '''
+    if number is None:
+        number = int(label_image.max())
+    index = np.flatnonzero(label_image)
+    label_pixel = label_image.ravel()[index]
+    stats = {"area": np.bincount(label_pixel, minlength=number+1)}
+    
+    if "bbox" in properties:
+        bbox = np.zeros((number+1, 4), dtype=np.int64)
+        for i, obj in enumerate(ndimage.find_objects(label_image, max_label=number), start=1):
+            if obj is not None:
+                bbox[i] = (obj[0].start, obj[1].start, obj[0].stop, obj[1].stop)
+        stats["bbox"] = bbox
+    
+    if "centroid" in properties or "moments" in properties:
+        rows, cols = np.divmod(index, label_image.shape[1])
+        area = np.maximum(stats["area"], 1)
+        centroid = np.stack([np.bincount(label_pixel, rows, number+1),
+                             np.bincount(label_pixel, cols, number+1)], axis=1) / area[:, None]
+        stats["centroid"] = centroid
+        
+        if "moments" in properties:
+            # centered coordinates, more accurate than sum(x**2) - area*mean**2
+            d_row = rows - centroid[label_pixel, 0]
+            d_col = cols - centroid[label_pixel, 1]
+            stats["moments"] = np.stack([np.bincount(label_pixel, d_row*d_row, number+1),
+                                         np.bincount(label_pixel, d_row*d_col, number+1),
+                                         np.bincount(label_pixel, d_col*d_col, number+1)], axis=1)
+    return stats
+
+
+def get_occupancy(image):
+    '''
+    Row and column projections of a binary image, used to locate the landmarks
+    return row_count, row_mean, col_count, col_mean
+        row_count : number of pixels in each row
+        row_mean : mean column index of the pixels of each row (nan if the row is empty)
+        col_count, col_mean : number of pixels and mean row index of each column
+    '''
+    height, width = image.shape
+    row_count = np.count_nonzero(image, axis=1)
+    col_count = np.count_nonzero(image, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        row_mean = (image @ np.arange(width)) / row_count
+        col_mean = (np.arange(height) @ image) / col_count
+        
+    return row_count, row_mean, col_count, col_mean
+
+
+class Trait_region:
+    '''
+    Cleaned region of a trait (biggest blob, holes filled) described by its image (crop of the bbox)
+    and its statistics from get_component_stats, in the coordinates of the full image.
+    Give the properties used from skimage regionprops (area, bbox, centroid, image, orientation...)
+    '''
+    
+    def __init__(self, image, bbox, area, centroid, moments):
+        self.image = image # bool array, crop of the bbox
+        self.bbox = tuple(int(v) for v in bbox)
+        self.area = int(area)
+        self.centroid = tuple(centroid)
+        self.moments = tuple(moments) # (mu_rr, mu_rc, mu_cc)
+        
+    @classmethod
+    def from_label(cls, label_image, value, stats, offset=(0, 0)):
+        '''
+        Create the region of the component "value" of label_image, using the stats of
+        get_component_stats. offset is the position (row, col) of label_image in the image
+        when it is a crop.
+        '''
+        min_row, min_col, max_row, max_col = stats["bbox"][value]
+        image = label_image[min_row:max_row, min_col:max_col] == value
+        row, col = offset
+        bbox = (min_row + row, min_col + col, max_row + row, max_col + col)
+        centroid = stats["centroid"][value] + np.array(offset)
+        return cls(image, bbox, stats["area"][value], centroid, stats["moments"][value])
+    
+    @cached_property
+    def occupancy(self):
+        '''
+        Row and column projections of the image (see get_occupancy), computed once
+        '''
+        return get_occupancy(self.image)
+    
+    @property
+    def slice(self):
+        min_row, min_col, max_row, max_col = self.bbox
+        return (slice(min_row, max_row), slice(min_col, max_col))
+    
+    @property
+    def coords(self):
+        return np.argwhere(self.image) + np.array(self.bbox[:2])
+    
+    @property
+    def inertia_tensor(self):
+        mu_rr, mu_rc, mu_cc = self.moments
+        return np.array([[mu_cc, -mu_rc], [-mu_rc, mu_rr]]) / self.area
+    
+    @property
+    def inertia_tensor_eigvals(self):
+        # sorted in decreasing order, like regionprops
+        eigvals = np.clip(np.linalg.eigvalsh(self.inertia_tensor), 0, None)
+        return sorted(eigvals, reverse=True)
+    
+    @property
+    def orientation(self):
+        '''
+        Angle (radian) between the row axis and the major axis, same convention as regionprops
+        '''
+        a, b, b, c = self.inertia_tensor.flat
+        if a - c == 0:
+            if b < 0:
+                return math.pi / 4.0
+            else:
+                return -math.pi / 4.0
+        else:
+            return 0.5 * math.atan2(-2 * b, c - a)
+        
+    @property
+    def axis_major_length(self):
+        return 4 * math.sqrt(self.inertia_tensor_eigvals[0])
+    
+    @property
+    def axis_minor_length(self):
+        return 4 * math.sqrt(self.inertia_tensor_eigvals[-1])
+    
+    @property
+    def equivalent_diameter_area(self):
+        return math.sqrt(4 * self.area / math.pi)
 
 
 class Segmented_image:
     
-    def __init__(self, file_name, align = True, cutoff = 0.6):
-        self.file = file_name
-        # expected name format "Unique_identifier_segmented.png" i.e "INHS_FISH_00072_segmented.png"
-        self.image_name = os.path.split(file_name)[1]
-        self.base_name = self.image_name.rsplit('_',1)[0] # extract unique_identifier
+    # combinations of traits used by the measurements, saved in the trait store with every trait
+    store_combinations = [('head', 'trunk'), ('head', 'trunk', 'caudal_fin')]
+    
+    def __init__(self, file_name, align = True, cutoff = 0.6, angle_tolerance = 0, base_name = None,
+                 coarse_factor = 1):
+        '''
+        file_name: path of the segmented image, or a label map (np.uint8 array of trait index,
+        i.e a view in a Label_stack) used without copy, base_name is then required
+        coarse_factor: coarse-to-fine mode for high resolution images when > 1, the fish angle,
+        the presence matrix and the regions of interest of the traits are calculated on the
+        label map sampled every coarse_factor pixels (see coarse_label_map), the traits are
+        cleaned and measured at full resolution inside these regions of interest.
+        Accuracy against the full resolution (coarse_factor 1):
+            + fish angle: error about 20 * coarse_factor / length of the fish (pixel) degree, i.e below
+            0.1 degree for a fish longer than 200 * coarse_factor pixels (measured on synthetic fish),
+            the rotation changes by the same amount, FA_pca is measured again on the aligned coarse label map
+            + presence: the blobs are counted on the coarse label map, a blob smaller than
+            coarse_factor x coarse_factor pixels can be missed and percentage is the ratio of the sampled areas
+            + measurements and landmarks: same calculation as the full resolution on the image aligned with
+            this angle. Largest differences measured on synthetic fish of 1600x640 and 3200x1280
+            (Benchmark_morphology.py --coarse_factor): landmarks 2 and 13 (top and bottom of the head,
+            middle of a nearly flat edge) move along the edge by up to 19 pixels at coarse_factor 2 and 4,
+            10 at 8, the other landmarks by up to 2 pixels (7 at 8), EA_m and HA_m by up to 6 and
+            14 pixels^2, FA_lm by up to 0.05 (0.1 at 8), the lengths by up to 1 pixel.
+            A part of a trait thinner than coarse_factor pixels and away from the sampled pixels
+            can be cut from the region of interest
+        '''
+        if isinstance(file_name, np.ndarray):
+            if base_name is None:
+                raise ValueError('base_name is required when the image is a label map')
+            self.file = None
+            self.image_name = None
+            self.base_name = base_name
+        else:
+            self.file = file_name
+            self.image_name = os.path.split(file_name)[1]
+            self.base_name = base_name or get_base_name(file_name)
         
         self.align =align
         self.cutoff = cutoff # minimum percent in area that a blob need to be valide trait
-        
-        self.trait_color_dict = {'background': [0, 0, 0],'dorsal_fin': [254, 0, 0],'adipos_fin': [0, 254, 0],
-                               'caudal_fin': [0, 0, 254],'anal_fin': [254, 254, 0],'pelvic_fin': [0, 254, 254],
-                               'pectoral_fin': [254, 0, 254],'head': [254, 254, 254],'eye': [0, 254, 102],
-                               'caudal_fin_ray': [254, 102, 102],'alt_fin_ray': [254, 102, 204],
-                               'trunk': [0, 124, 124]}
-        
-        self.img_arr = self.import_image(file_name)
-        self.fish_angle = self.get_fish_angle_pca()
+        self.angle_tolerance = angle_tolerance # (degree) the fish is not rotated below this angle
+        self.coarse_factor = int(coarse_factor)
+        
+        self.trait_color_dict = dict(trait_color_dict)
+        # value of each trait in the label map, position in trait_color_dict (background is 0)
+        self.trait_index = {trait: i for i, trait in enumerate(self.trait_color_dict)}
+        
+        # cleaned regions by trait name or tuple of trait names, see get_trait_region()
+        self.region_cache = {}
+        # the image is only kept as a label map, see read_label_map()
+        if self.file is None:
+            self.label_map = file_name
+        else:
+            self.label_map = self.import_label_map(file_name)
+        fish_angle = self.get_fish_angle_pca(rounded=False)
+        self.fish_angle = round(fish_angle,2) + 0.0
         
         if align:
-            self.img_arr = self.align_fish() 
             self.old_fish_angle = self.fish_angle
-            self.fish_angle = self.get_fish_angle_pca()
+            if abs(self.fish_angle) > angle_tolerance:
+                self.label_map = self.align_fish() 
+                # angle measured again on the aligned fish (FA_pca), the rotation with nearest
+                # neighbour and the cleaning of the rotated mask leave a small angle
+                self.fish_angle = self.get_fish_angle_pca()
                     
-        self.get_channels_mask()
         self.presence_matrix = self.get_presence_matrix()
+    
+    @property
+    def label_map(self):
+        return self._label_map
+    
+    @label_map.setter
+    def label_map(self, label_map):
+        '''
+        The masks and cleaned regions are computed from the label map, a new label map invalidate them.
+        '''
+        self._label_map = label_map
+        self.get_channels_mask()
+    
+    @property
+    def img_arr(self):
+        '''
+        Color image (RGB) created from the label map
+        '''
+        colors = np.array(list(self.trait_color_dict.values()), dtype=np.uint8)
+        return colors[self.label_map]
+    
+    @img_arr.setter
+    def img_arr(self, img_arr):
+        self.label_map = self.get_label_map(img_arr)
+    
+    def clear_region_cache(self):
+        '''
+        Forget the cleaned regions kept by get_trait_region()
+        '''
+        self.region_cache = {}
                         
     def import_image(self,file_name):
         '''
@@ -66,16 +456,22 @@ class Segmented_image:
 
         return img_arr
 
-    def get_fish_angle_pca(self):
+    @profiled('get_fish_angle_pca')
+    def get_fish_angle_pca(self, rounded=True):
         '''
         Calculate orientation (PCA) of the mask of whole fish
         We choose to combine whole fish part and calculate orientation.
-        return value in degree
+        return value in degree, rounded to 0.01 if rounded
         '''
         
-        # create a mask with all the fish traits 
-        img_arr = self.img_arr
-        whole_fish = np.sum(img_arr,axis=2).astype(bool)      
+        # create a mask with all the fish traits, inside their bounding box
+        if self.coarse_factor > 1:
+            # the orientation doesn't depend on the scale, the coarse label map is enough
+            whole_fish = self.coarse_label_map > 0
+        else:
+            list_trait = [trait for trait in self.mask if self.trait_area[self.trait_index[trait]] > 0]
+            roi = self.get_trait_roi(list_trait)
+            whole_fish = self.label_map[roi] > 0
 
         # Clean holes and remove isolated blobs and create a regionprop
         trait_region = self.clean_trait_region(whole_fish)   
@@ -83,63 +479,107 @@ class Segmented_image:
         #fish_angle = (90-angle_rad*180/math.pi)
         fish_angle = np.sign(angle_rad) * (90-abs(angle_rad*180/math.pi))
         
+        if not rounded:
+            return fish_angle
         # + 0.0 remove negative sign on rounded 0.0 value
         return round(fish_angle,2) + 0.0 
     
 
+    @profiled('align_fish')
     def align_fish(self):
         '''
         Development
         To align the fish horizontally
         in order to get landmark 5 and 6
+        Rotate the label map with nearest neighbour (the default of PIL), same result as
+        rotating the color image
         '''
         
-        img_arr = self.img_arr
+        label_map = self.label_map
         angle_deg = self.fish_angle
         
-        image_align = Image.fromarray(img_arr).rotate(angle_deg)
+        image_align = Image.fromarray(label_map).rotate(angle_deg)
         
         return  np.array(image_align, dtype=np.uint8)    
         
     
+    def import_label_map(self, file_name):
+        '''
+        Import the segmented image (RGB, palette or label png, npy) as a label map, see read_label_map()
+        '''
+        return read_label_map(file_name, self.trait_color_dict)
+    
+    def save_label_map(self, file_name):
+        '''
+        Save the label map (aligned if align) as a palette png or npy, see write_label_map()
+        '''
+        write_label_map(self.label_map, file_name, self.trait_color_dict)
+    
+    def get_color_lookup(self):
+        '''
+        Lookup tables used to convert a RGB color to its trait index, see color_lookup()
+        '''
+        return color_lookup(self.trait_color_dict)
+    
+    def get_label_map(self, img):
+        '''
+        Convert the png image (numpy.ndarray, np.uint8)  (320, 800, 3)
+        to a label map (320, 800) np.uint8 with the trait index of every pixel
+        (see trait_index), a color not in trait_color_dict is background (0)
+        '''
+        return rgb_to_label_map(img, self.trait_color_dict)
+    
+    @profiled('get_channels_mask')
     def get_channels_mask(self):
         ''' 
-        Convert the png image (numpy.ndarray, np.uint8)  (320, 800, 3)
-        to a mask_channel (320, 800, 12) Binary map
-
-        input
-        output
-        img shape -> (320, 800, 3) if normal=True
-        else: mask shape -> (11, 320, 800)
-            we want to output a PIL image with rgb color value
-            '''
-        trait_color_dict = self. trait_color_dict
-        img = self.img_arr
-        mask = {}
-        for i, (trait, color) in enumerate(trait_color_dict.items()):
-            if trait != "background":
-                
-                trait_mask = (img[:, :, 0] == color[0]) &\
-                            (img[:, :, 1] == color[1]) &\
-                            (img[:, :, 2] == color[2])
-                mask[trait]=trait_mask.astype("uint8")
-                
-        self.mask = mask
+        Give access to the binary mask of each trait from the label map (320, 800)
+        created by get_label_map, mask[trait] -> (320, 800) uint8
+
+        The masks are created on demand from the label map (see Trait_masks)
+        instead of storing 11 masks.
+        '''
+        # number of pixels of each trait
+        self.trait_area = np.bincount(self.label_map.ravel(), minlength=len(self.trait_index))
+        trait_index = {trait: i for trait, i in self.trait_index.items() if trait != "background"}
+        self.mask = Trait_masks(self.label_map, trait_index)
+        # bounding box of each trait, see get_trait_roi()
+        self.trait_slices = None
+        self.clear_region_cache()
+    
+    @property
+    def coarse_label_map(self):
+        '''
+        Label map sampled every coarse_factor pixels (view, no copy), used in coarse-to-fine mode
+        '''
+        return self.label_map[::self.coarse_factor, ::self.coarse_factor]
     
     def remove_holes(self, image):
-        
-        seed = np.copy(image)
-        seed[1:-1, 1:-1] = image.max()
-        mask = image
-        filled = reconstruction(seed, mask, method='erosion')
-        return filled
+        '''
+        Fill the holes of a binary mask: the background areas that are not connected
+        (8-connectivity) to the border of the image.
+        Same result as the morphological reconstruction by erosion with a seed equal
+        to the border of the image, but in a single labeling pass.
+        return filled mask uint8 (0, 1)
+        '''
+        # label the background areas, and find the ones touching the border
+        background_label, _ = ndimage.label(image == 0, structure=np.ones((3, 3)))
+        is_border = np.zeros(background_label.max() + 1, dtype=bool)
+        for border in [background_label[0, :], background_label[-1, :], background_label[:, 0], background_label[:, -1]]:
+            is_border[border] = True
+        # 0 is the trait itself
+        is_border[0] = False
+        
+        filled = np.logical_not(is_border[background_label])
+        return filled.view(np.uint8)
    
     
-    def clean_trait_region(self, trait_mask):
+    @profiled('clean_trait_region')
+    def clean_trait_region(self, trait_mask, offset=(0, 0)):
         '''
         Clean the mask_trait (remove holes)
         Find the biggest region
-        return region_trait
+        offset is the position (row, col) of trait_mask in the image when it is a crop
+        return region_trait (Trait_region)
         '''
         # percent area of the biggest blob below which the trait is excluded
         # in other word if a trait is composed of lot of small blobs with none having more than 
@@ -148,42 +588,148 @@ class Segmented_image:
         # remove hole/fill empty area
         trait_filled = self.remove_holes(trait_mask)
         
+        trait_label, number = label(trait_filled, return_num=True)
+        area = get_component_stats(trait_label, number, properties=["area"])["area"]
         # total area of the trait
-        total_area = np.count_nonzero(trait_filled == 1)
-        trait_label = label(trait_filled)
-        trait_region = regionprops(trait_label)
+        total_area = area[1:].sum()
+        trait_region = []
         
         if total_area>0:
         
-            # Get the biggest instance(blob) of the trait
-            biggest_region = sorted(trait_region, key=lambda r: r.area, reverse=True)[0]
-            percent = biggest_region.area/total_area
+            # Get the biggest instance(blob) of the trait, the first one if equal area
+            biggest = np.argmax(area[1:]) + 1
+            percent = area[biggest]/total_area
             if percent >=percent_cutoff:
-                trait_region = biggest_region                
-            else:
-                trait_region =[]
+                # statistics of the biggest blob only
+                biggest_label = np.where(trait_label == biggest, biggest, 0)
+                stats = get_component_stats(biggest_label, biggest)
+                trait_region = Trait_region.from_label(biggest_label, biggest, stats, offset)
         return trait_region
     
+    def get_trait_region(self, trait):
+        '''
+        Cleaned region (see clean_trait_region) of a trait "head" or of a combination
+        of traits ("head", "trunk") using combine_trait_mask.
+        The region is computed once per image and kept in self.region_cache
+        return region_trait or [] if the trait is missing or rejected
+        '''
+        key = trait if isinstance(trait, str) else tuple(trait)
+        if key not in self.region_cache:
+            if self.label_map is None:
+                raise KeyError(f'{key} is not in the trait store, no label map to compute it')
+            list_trait = [key] if isinstance(key, str) else list(key)
+            # work only inside the bounding box of the trait
+            roi = self.get_trait_roi(list_trait)
+            
+            if roi:
+                trait_mask = self.combine_trait_mask(list_trait, roi=roi)
+                offset = (roi[0].start, roi[1].start)
+                self.region_cache[key] = self.clean_trait_region(trait_mask, offset)
+            else:
+                self.region_cache[key] = []
+        return self.region_cache[key]
+    
+    def get_trait_roi(self, list_trait, margin=1):
+        '''
+        Region of interest of a list of traits: bounding box containing all the traits
+        plus a margin (pixel) clipped to the image. A margin of 1 pixel keeps the
+        background around the trait, so remove_holes gives the same result as on the full image.
+        In coarse-to-fine mode the bounding boxes come from the coarse label map, scaled
+        and extended by one coarse pixel (coarse_factor) on every side.
+        return tuple of slices (rows, columns) or None if one of the traits is missing
+        '''
+        factor = self.coarse_factor
+        if self.trait_slices is None:
+            # bounding box of every value of the label map in one pass
+            label_map = self.coarse_label_map if factor > 1 else self.label_map
+            self.trait_slices = ndimage.find_objects(label_map, max_label=len(self.trait_index)-1)
+        
+        list_slice = [self.trait_slices[self.trait_index[trait]-1] for trait in list_trait]
+        if any(trait_slice is None for trait_slice in list_slice):
+            return None
+        
+        if factor > 1:
+            margin = margin + factor
+        height, width = self.label_map.shape
+        min_row = max(min(s[0].start for s in list_slice)*factor - margin, 0)
+        max_row = min(max(s[0].stop for s in list_slice)*factor + margin, height)
+        min_col = max(min(s[1].start for s in list_slice)*factor - margin, 0)
+        max_col = min(max(s[1].stop for s in list_slice)*factor + margin, width)
+        
+        return (slice(min_row, max_row), slice(min_col, max_col))
+    
+    def save_trait_store(self, file_name):
+        '''
+        Save the cleaned regions (see get_trait_region) of every trait and of store_combinations
+        in a .npz file, read by Measure_morphology.from_trait_store.
+        The image of a region (crop of its bbox) is bit-packed and compressed, its bbox, area, centroid
+        and moments are saved in the header (json) with the presence matrix and the fish angle.
+        '''
+        write_trait_store(file_name, *self.get_trait_store())
+    
+    def get_trait_store(self):
+        '''
+        Content of the trait store (see save_trait_store), saved by write_trait_store()
+        return header (dict), arrays {region name: bit-packed image}
+        '''
+        list_key = [trait for trait in self.trait_index if trait != 'background'] + self.store_combinations
+        header = {'version': 1, 'base_name': self.base_name, 'shape': list(self.label_map.shape),
+                  'align': self.align, 'cutoff': self.cutoff, 'angle_tolerance': self.angle_tolerance,
+                  'coarse_factor': self.coarse_factor,
+                  'fish_angle': self.fish_angle, 'presence_matrix': self.presence_matrix,
+                  'trait_area': {trait: int(self.trait_area[i]) for trait, i in self.trait_index.items()},
+                  'regions': {}}
+        arrays = {}
+        for key in list_key:
+            region = self.get_trait_region(key)
+            name = key if isinstance(key, str) else '+'.join(key)
+            header['regions'][name] = None
+            if region:
+                header['regions'][name] = {'bbox': list(region.bbox), 'area': region.area,
+                                           'centroid': [float(v) for v in region.centroid],
+                                           'moments': [float(v) for v in region.moments]}
+                arrays[name] = np.packbits(region.image, axis=None)
+        return header, arrays
+    
+    @profiled('get_presence_matrix')
     def get_presence_matrix(self):
         '''
         Create a matrix with presence, number of blob, percent of the biggest
         instance for each trait
+        The traits are disjoint, so the blobs of all the traits are labeled at once
+        in the label map (neighbor pixels are connected when they have the same trait value)
+        In coarse-to-fine mode the blobs are labeled in the coarse label map
         '''
-        mask = self.mask
+        label_map = self.label_map
+        trait_area = self.trait_area
+        if self.coarse_factor > 1:
+            label_map = self.coarse_label_map
+            trait_area = np.bincount(label_map.ravel(), minlength=len(self.trait_index))
+        trait_index = self.trait_index
         presence_matrix = {}
         
-        for i, (trait_name, trait_mask) in enumerate(mask.items()):
-
+        blob_label, number = label(label_map, background=0, return_num=True)
+        blob_area = get_component_stats(blob_label, number, properties=["area"])["area"]
+        
+        # trait value of each blob
+        index = np.flatnonzero(blob_label)
+        blob_trait = np.zeros(number+1, dtype=np.int64)
+        blob_trait[blob_label.ravel()[index]] = label_map.ravel()[index]
+        
+        # number of blob and area of the biggest blob per trait
+        trait_number = np.bincount(blob_trait[1:], minlength=len(trait_index))
+        trait_biggest = np.zeros(len(trait_index), dtype=np.int64)
+        np.maximum.at(trait_biggest, blob_trait[1:], blob_area[1:])
+        
+        for trait_name, i in trait_index.items():
+            if trait_name == "background":
+                continue
+            
             temp_dict = {}
-            total_area = np.count_nonzero(trait_mask == 1)
-            label_trait = label(trait_mask)
-            trait_regions = regionprops(label_trait)
-
-            temp_dict["number"] = len(trait_regions)
+            temp_dict["number"] = int(trait_number[i])
         
-            if len(trait_regions) > 0:
-                biggest_region = sorted(trait_regions, key=lambda r: r.area, reverse=True)[0]
-                temp_dict["percentage"] = biggest_region.area/total_area
+            if trait_number[i] > 0:
+                temp_dict["percentage"] = trait_biggest[i]/trait_area[i]
             else: 
                     temp_dict["percentage"] = 0
 
@@ -194,19 +740,127 @@ class Segmented_image:
         
 class Measure_morphology(Segmented_image):
     
-    def __init__(self, file_name, align=True):
+    # trait used to locate each landmark, the landmarks of a trait are calculated together
+    landmark_trait = {'1': 'head', '2': 'head', '3': 'dorsal_fin', '4': 'dorsal_fin', '5': 'caudal_fin',
+                      '6': 'trunk', '7': 'caudal_fin', '8': 'anal_fin', '9': 'anal_fin', '10': 'pelvic_fin',
+                      '11': 'pectoral_fin', '12': 'head', '13': 'head', '14': 'eye', '15': 'eye',
+                      '16': 'eye', '17': 'eye', '18': 'eye'}
+    # measurements that are the distance between 2 landmarks
+    landmark_distance = {'SL_lm': ('1', '6'), 'HL_lm': ('1', '12'), 'ED_lm': ('14', '15'),
+                         'pOD_lm': ('1', '14'), 'HD_lm': ('2', '13')}
+    
+    def __init__(self, file_name, align=True, cutoff=0.6, angle_tolerance=0, base_name=None, coarse_factor=1):
+        '''
+        The landmarks and measurements are calculated the first time they are requested
+        (get_landmark, get_measure or the properties landmark, measurement_with_bbox...)
+        '''
+        super().__init__(file_name, align=align, cutoff=cutoff, angle_tolerance=angle_tolerance, base_name=base_name,
+                         coarse_factor=coarse_factor)
+        
+    @classmethod
+    def from_trait_store(cls, file_name):
+        '''
+        Create the object from a trait store (see save_trait_store) instead of the segmented image:
+        nothing is decoded, aligned or cleaned, the landmarks and measurements are calculated
+        from the stored regions. The label map is not stored, so the visualizations and
+        the regions of other combinations of traits are not available.
+        '''
+        with np.load(file_name) as store:
+            header = json.loads(str(store['header']))
+            arrays = {name: store[name] for name in header['regions'] if header['regions'][name]}
         
-        super().__init__(file_name, align=True)
-        self.get_all_measures_landmarks()
+        self = cls.__new__(cls)
+        self.file = file_name
+        self.image_name = None
+        self.base_name = header['base_name']
+        self.align = header['align']
+        self.cutoff = header['cutoff']
+        self.angle_tolerance = header['angle_tolerance']
+        self.coarse_factor = header.get('coarse_factor', 1)
+        self.trait_color_dict = dict(trait_color_dict)
+        self.trait_index = {trait: i for i, trait in enumerate(self.trait_color_dict)}
+        self._label_map = None
+        self.mask = None
+        self.trait_slices = None
+        self.trait_area = np.array([header['trait_area'].get(trait, 0) for trait in self.trait_index])
+        self.fish_angle = header['fish_angle']
+        self.presence_matrix = header['presence_matrix']
+        
+        self.clear_region_cache()
+        for name, value in header['regions'].items():
+            key = tuple(name.split('+')) if '+' in name else name
+            if value:
+                min_row, min_col, max_row, max_col = value['bbox']
+                shape = (max_row - min_row, max_col - min_col)
+                image = np.unpackbits(arrays[name], count=shape[0]*shape[1]).reshape(shape).view(bool)
+                self.region_cache[key] = Trait_region(image, value['bbox'], value['area'],
+                                                      value['centroid'], value['moments'])
+            else:
+                self.region_cache[key] = []
+        return self
+        
+    def clear_region_cache(self):
+        '''
+        Forget the cleaned regions and the landmarks and measurements calculated from them
+        '''
+        super().clear_region_cache()
+        self.landmark_cache = {}
+        self.measure_cache = {}
     
     def get_all_measures_landmarks(self):
         '''
         Execute the multiple functions that calculate landmarks and measurements
         '''
-        self.landmark = self.all_landmark()
-        self.measurement_with_bbox = self.all_measure_using_bbox()
-        self.measurement_with_lm = self.all_measure_using_lm()
-        self.measurement_with_area = self.all_measure_area()
+        self.all_landmark()
+        self.all_measure_using_bbox()
+        self.all_measure_using_lm()
+        self.all_measure_area()
+        
+    @property
+    def landmark(self):
+        return self.all_landmark()
+    
+    @property
+    def measurement_with_bbox(self):
+        return self.all_measure_using_bbox()
+    
+    @property
+    def measurement_with_lm(self):
+        return self.all_measure_using_lm()
+    
+    @property
+    def measurement_with_area(self):
+        return self.all_measure_area()
+        
+    def get_landmark(self, key):
+        '''
+        Landmark "key" ('1' to '18'), calculated with the other landmarks of the same trait
+        the first time one of them is requested
+        '''
+        if key not in self.landmark_cache:
+            self.landmark_cache.update(self.landmark_of_trait(self.landmark_trait[key]))
+        return self.landmark_cache[key]
+    
+    def get_measure(self, name):
+        '''
+        Measurement "name" (SL_bbox, HL_lm, EA_m...), calculated the first time it is requested
+        '''
+        if name not in self.measure_cache:
+            measure_function = {'SL_bbox': self.measure_SL_bbox,
+                                'HL_bbox': lambda: self.measure_length_bbox('head'),
+                                'ED_bbox': lambda: self.measure_length_bbox('eye'),
+                                'pOD_bbox': self.measure_pOD_bbox,
+                                'FA_pca': lambda: self.fish_angle,
+                                'HH_lm': lambda: self.measure_head_depth_lm()[0],
+                                'HH_lm_v2': lambda: self.measure_head_depth_lm()[1],
+                                'FA_lm': self.measure_fish_angle_lm,
+                                'EA_m': self.measure_eye_area,
+                                'HA_m': self.measure_head_area}
+            if name in self.landmark_distance:
+                self.measure_cache[name] = self.measure_landmark_distance(name)
+            else:
+                self.measure_cache[name] = measure_function[name]()
+        return self.measure_cache[name]
     
     def get_distance(self, a,b):
         '''
@@ -235,64 +889,83 @@ class Measure_morphology(Segmented_image):
             
         return distance_matrix
     
-    def combine_trait_mask(self, list_trait=['head','trunk']):
-        
-        mask = self.mask
-        combo = np.zeros_like(mask,dtype="uint8")
+    def combine_trait_mask(self, list_trait=['head','trunk'], roi=None):
+        '''
+        Create one binary mask (uint8) with all the traits of list_trait
+        roi: tuple of slices (rows, columns) to create the mask only on this part of the image
+        return None if one of the trait is missing
+        '''
+        trait_index = self.trait_index
+        selected = np.zeros(len(trait_index), dtype="uint8")
         
         for trait in list_trait:
-            if np.any(mask[trait]):
-                combo = combo + mask[trait]
+            if self.trait_area[trait_index[trait]] > 0:
+                selected[trait_index[trait]] = 1
             else:
                 return None
             
         #combo_cleaned = self.remove_holes(combo)
+        label_map = self.label_map if roi is None else self.label_map[roi]
         
-        return combo
+        return np.take(selected, label_map)
         
 #######################
 # Measure the landamrks    
 #######################
-    def landmark_generic(self, trait_name):
+    def get_trait_landmark(self, trait_name):
         '''
         Identify landmark of a trait (trait_name)
         front, back, top, bottom of the trait and center
         this function works only if the fish is oriented head facing left
+        The landmarks are found from the row and column projections of the cleaned region
+        return front, back, top, bottom, centroid, region (Trait_region)
         '''
-        
-        mask = self.mask[trait_name]
         # remove the hole and take the biggest blob
-        clean_mask = self.clean_trait_region(mask)
-        # Create new mask with clean mask, remove hole and secondary blob
-        # use clean_mask (region) to reconstruct a mask
-        if clean_mask:
-            bbox = clean_mask.bbox
-            new_mask = np.zeros_like(mask)
-            new_mask[bbox[0]:bbox[2],bbox[1]:bbox[3]]=clean_mask.image
+        region = self.get_trait_region(trait_name)
+        
+        if region:
+            min_row, min_col, max_row, max_col = region.bbox
+            row_count, row_mean, col_count, col_mean = region.occupancy
             
-            x,y = np.where(new_mask)
-            # top
-            x_top=x.min()
-            y_top = round(np.mean(np.where(new_mask[x_top,:])))
-            top_lm = (int(x_top),int(y_top))
-    
-            # bottom
-            x_bottom=x.max()
-            y_bottom = round(np.mean(np.where(new_mask[x_bottom,:])))
-            bottom_lm = (int(x_bottom),int(y_bottom))
+            # first and last non empty row and column
+            row_top = np.argmax(row_count > 0)
+            row_bottom = len(row_count) - 1 - np.argmax(row_count[::-1] > 0)
+            col_front = np.argmax(col_count > 0)
+            col_back = len(col_count) - 1 - np.argmax(col_count[::-1] > 0)
+            
+            # top, middle of the first row
+            top_lm = (int(row_top + min_row),int(round(row_mean[row_top] + min_col)))
+    
+            # bottom, middle of the last row
+            bottom_lm = (int(row_bottom + min_row),int(round(row_mean[row_bottom] + min_col)))
             
-            #front 
-            y_front = y.min()
-            x_front = round(np.mean(np.where(new_mask[:, y_front,])))
-            front_lm = (int(x_front),int(y_front))
+            #front, middle of the first column
+            front_lm = (int(round(col_mean[col_front] + min_row)),int(col_front + min_col))
             
-            #back 
-            y_back=y.max()
-            x_back = round(np.mean(np.where(new_mask[:, y_back,])))
-            back_lm = (int(x_back),int(y_back))
-            centroid = clean_mask.centroid
+            #back, middle of the last column
+            back_lm = (int(round(col_mean[col_back] + min_row)),int(col_back + min_col))
+            centroid = region.centroid
+        else:
+            front_lm , back_lm, top_lm, bottom_lm, centroid = [], [], [], [], []
+        
+        return front_lm, back_lm, top_lm, bottom_lm, centroid, region
+    
+    def landmark_generic(self, trait_name):
+        '''
+        Identify landmark of a trait (trait_name)
+        front, back, top, bottom of the trait and center
+        this function works only if the fish is oriented head facing left
+        Same as get_trait_landmark but return the cleaned mask of the trait with the
+        size of the image (new_mask) instead of the region
+        '''
+        front_lm, back_lm, top_lm, bottom_lm, centroid, region = self.get_trait_landmark(trait_name)
+        
+        # use region to reconstruct a mask
+        if region:
+            new_mask = np.zeros_like(self.label_map)
+            new_mask[region.slice] = region.image
         else:
-            front_lm , back_lm, top_lm, bottom_lm, centroid, new_mask = [], [], [], [], [], []
+            new_mask = []
         
         return front_lm, back_lm, top_lm, bottom_lm, centroid, new_mask
     
@@ -302,67 +975,76 @@ class Measure_morphology(Segmented_image):
         We split the caudal fin upper and lower part (horizontal line through the middle).
         Then, in each case get the mot left point in the half of the caudal fin
         '''
-        _,_,_,_,center_caudal,new_mask_caudal= self.landmark_generic('caudal_fin')
+        _,_,_,_,center_caudal,region_caudal= self.get_trait_landmark('caudal_fin')
         
-        if np.any(new_mask_caudal):
-            mask_caudal_5 = new_mask_caudal.copy()
-            mask_caudal_7 = new_mask_caudal.copy()
-            row_caudal = round(center_caudal[0])
-
-            mask_caudal_5[row_caudal:,:] = 0
-            mask_caudal_7[:row_caudal,:] = 0
+        if region_caudal:
+            min_row, min_col, _, _ = region_caudal.bbox
+            image = region_caudal.image
+            # row of the center in the crop
+            row_caudal = round(center_caudal[0]) - min_row
+            
+            # upper part starts at the first row of the bbox, lower part at the center
+            mask_caudal_5 = image[:row_caudal,:]
+            mask_caudal_7 = image[row_caudal:,:]
         
             lm_5_7=[]
-            for temp_mask in [mask_caudal_5,mask_caudal_7]:        
-                x,y = np.where(temp_mask)
-                y_front = y.min()
-                x_front = round(np.mean(np.where(temp_mask[:, y_front,])))
-                lm_5_7.append((int(x_front),int(y_front)))
+            for temp_mask, row_start in [(mask_caudal_5, min_row), (mask_caudal_7, min_row + row_caudal)]:
+                _, _, col_count, col_mean = get_occupancy(temp_mask)
+                if not np.any(col_count):
+                    raise ValueError('landmark 5 and 7: empty half of the caudal fin')
+                y_front = np.argmax(col_count > 0)
+                x_front = round(col_mean[y_front] + row_start)
+                lm_5_7.append((int(x_front),int(y_front + min_col)))
                 
             return lm_5_7[0], lm_5_7[1]   
         else: 
             return [],[]
         
-    def all_landmark(self):
+    def landmark_of_trait(self, trait_name):
         '''
-        Calculate of the landmark
-        front, back, top, bottom, center, new_mask = self.landmark_generic(trait_name)
+        Calculate the landmarks located with trait_name (see landmark_trait)
+        front, back, top, bottom, center, region = self.get_trait_landmark(trait_name)
+        return dictionnary {landmark number: (row, col) or []}
         '''
-        cutoff =  self.cutoff
-        presence_matrix = self.presence_matrix
-        
         # initialize a dictionnary with keys and empty lists as value
-        landmark={str(k):[] for k in range(1,19)}
+        landmark = {k: [] for k, trait in self.landmark_trait.items() if trait == trait_name}
 
         #eye
-        if presence_matrix['eye']['percentage']>=cutoff:
-            
-            landmark['14'], landmark['15'], landmark['16'], landmark['17'], center_eye, _ = self.landmark_generic('eye')
-            landmark['18'] = (round(center_eye[0]), round(center_eye[1]))
-            
+        if trait_name == 'eye':
+            if self.presence_matrix['eye']['percentage']>=self.cutoff:
+                landmark['14'], landmark['15'], landmark['16'], landmark['17'], center_eye, _ = self.get_trait_landmark('eye')
+                landmark['18'] = (round(center_eye[0]), round(center_eye[1]))
             
         # head
-        landmark['1'], landmark['12'], landmark['2'] , landmark['13'], _, new_mask_head = self.landmark_generic('head')
+        elif trait_name == 'head':
+            landmark['1'], landmark['12'], landmark['2'] , landmark['13'], _, _ = self.get_trait_landmark('head')
         
         #landmark #5 and 7 caudal fin
-        landmark['5'], landmark['7'] = self.landmark_5_7()
+        elif trait_name == 'caudal_fin':
+            landmark['5'], landmark['7'] = self.landmark_5_7()
         
         #trunk
-        _, landmark['6'],_ ,_ ,_ ,_ = self.landmark_generic('trunk')
+        elif trait_name == 'trunk':
+            _, landmark['6'],_ ,_ ,_ ,_ = self.get_trait_landmark('trunk')
         
         # Fins : ['dorsal_fin', 'anal_fin', 'pelvic_fin', 'pectoral_fin']
-        landmark['3'],_ , _, landmark['4'], _,  _ = self.landmark_generic('dorsal_fin')
-        landmark['11'],_ , _,_, _, _ = self.landmark_generic('pectoral_fin')
-        landmark['10'],_ , _,_, _, _ = self.landmark_generic('pelvic_fin')
-        landmark['9'], _, landmark['8'] , _, _, _ = self.landmark_generic('anal_fin')
-        
-        # reorder the keys of the dictionnary 
-        new_landmark={}
-        list_order = [str(i) for i in range(1,19)]
-        for key in list_order:
-            new_landmark[key] = landmark[key]                     
-                                
-        return new_landmark
+        elif trait_name == 'dorsal_fin':
+            landmark['3'],_ , _, landmark['4'], _,  _ = self.get_trait_landmark('dorsal_fin')
+        elif trait_name == 'pectoral_fin':
+            landmark['11'],_ , _,_, _, _ = self.get_trait_landmark('pectoral_fin')
+        elif trait_name == 'pelvic_fin':
+            landmark['10'],_ , _,_, _, _ = self.get_trait_landmark('pelvic_fin')
+        elif trait_name == 'anal_fin':
+            landmark['9'], _, landmark['8'] , _, _, _ = self.get_trait_landmark('anal_fin')
+        
+        return landmark
+        
+    def all_landmark(self):
+        '''
+        Calculate of the landmark
+        return dictionnary ordered from '1' to '18'
+        '''
+        return {key: self.get_landmark(key) for key in self.landmark_trait}
     
 ####################################
 # Calculate measurements using landmarks
@@ -373,8 +1055,7 @@ class Measure_morphology(Segmented_image):
         Calculate eye area after cleaning and filing hole
         
         '''
-        mask = self.mask
-        eye_region = self.clean_trait_region(mask['eye'])
+        eye_region = self.get_trait_region('eye')
         if eye_region:
             return eye_region.area
         else:
@@ -385,8 +1066,7 @@ class Measure_morphology(Segmented_image):
         Calculate head area  after cleaning and filing hole
         
         '''
-        mask = self.mask
-        head_region = self.clean_trait_region(mask['head'])
+        head_region = self.get_trait_region('head')
         
         if head_region:
             return head_region.area
@@ -413,9 +1093,8 @@ class Measure_morphology(Segmented_image):
         Calculate eye equivalent diameter : diameter of the disk of the same area
         (area/pi)^1/2
         '''
-        mask = self.mask
         eq_diameter = 0
-        eye_region = self.clean_trait_region(mask['eye'])
+        eye_region = self.get_trait_region('eye')
         if  eye_region:   
             eq_diameter = eye_region.equivalent_diameter_area
             
@@ -439,18 +1118,21 @@ class Measure_morphology(Segmented_image):
         '''
         Measure horizontal length of the head passing by the center of the eye
         '''
-        #eye
-        _, _, _, _, center_eye, _ = self.landmark_generic('eye')     
-
-        # head
-        _, _, _, _, _, new_mask_head = self.landmark_generic('head')
-        # head length, vertical line of the head passing by the center of the eye
+        head_length = 'None'
+        start_h = 'None'
+        end_h = 'None'
         
-        if center_eye and np.any(new_mask_head):
-            row_eye = round(center_eye[0])
+        eye_region = self.get_trait_region('eye')
+        head_region = self.get_trait_region('head')
+        # head length, horizontal line of the head passing by the center of the eye
         
-            head_hori_line = new_mask_head[row_eye,:]
-            index_hori = np.where(head_hori_line == 1)[0]
+        if eye_region and head_region:
+            row_eye = round(eye_region.centroid[0])
+            min_row, min_col, max_row, max_col = head_region.bbox
+            
+            # the line is empty outside of the bbox of the head
+            head_hori_line = head_region.image[row_eye-min_row,:] if min_row <= row_eye < max_row else np.zeros(0)
+            index_hori = np.where(head_hori_line == 1)[0] + min_col
         
             # Get start and end of the horizontal line to check
             start_h = (row_eye,np.max(index_hori))
@@ -468,20 +1150,20 @@ class Measure_morphology(Segmented_image):
         start_v = 'None'
         end_v = 'None'
         
-        #eye
-        _, _, _, _, center_eye, _ = self.landmark_generic('eye')     
-        # head
-        _, _, _, _, _, new_mask_head = self.landmark_generic('head')
+        eye_region = self.get_trait_region('eye')
+        head_region = self.get_trait_region('head')
         
-        if center_eye and np.any(new_mask_head):
+        if eye_region and head_region:
         
-            # head depth, horizontal line of the head passing by the center of the eye
-            col_eye = round(center_eye[1])
+            # head depth, vertical line of the head passing by the center of the eye
+            col_eye = round(eye_region.centroid[1])
+            min_row, min_col, max_row, max_col = head_region.bbox
         
-            head_vert_line = new_mask_head[:,col_eye]
+            # the line is empty outside of the bbox of the head
+            head_vert_line = head_region.image[:,col_eye-min_col] if min_col <= col_eye < max_col else np.zeros(0)
         
             # Calculate the start and end of the vertical line, for sanity check
-            index_verti = np.where(head_vert_line == 1)[0]
+            index_verti = np.where(head_vert_line == 1)[0] + min_row
             start_v = (np.max(index_verti),col_eye)
             end_v = (np.min(index_verti),col_eye)
         
@@ -497,10 +1179,9 @@ class Measure_morphology(Segmented_image):
         get bbox and get length of bbox
         '''
         body_length = 'None'
-        head_trunk_caudal = self.combine_trait_mask(['head','trunk','caudal_fin'])
-        if np.any(head_trunk_caudal):
+        trait_region = self.get_trait_region(['head','trunk','caudal_fin'])
+        if trait_region:
             
-            trait_region= self.clean_trait_region(head_trunk_caudal)
             xb0, yb0, xb1, yb1 = trait_region.bbox
             body_length = yb1-yb0
     
@@ -510,50 +1191,58 @@ class Measure_morphology(Segmented_image):
         '''
         measure fish angle using orientation of the line define by landmark#1 and landmark #6
         '''
-        landmark = self.landmark
+        landmark_1 = self.get_landmark('1')
+        landmark_6 = self.get_landmark('6')
         fish_angle_lm = 'None'
-        if landmark['1'] and landmark['6']:
+        if landmark_1 and landmark_6:
             
             # translation to origin
-            trans_to_origin = list(map(sub, landmark['6'], landmark['1']))
+            trans_to_origin = list(map(sub, landmark_6, landmark_1))
             fish_angle_lm = math.atan2(trans_to_origin[0], trans_to_origin[1])*(180/math.pi)
             fish_angle_lm = round(fish_angle_lm,2)
             
         return fish_angle_lm
     
+    def measure_landmark_distance(self, name):
+        '''
+        Measure the distance between the 2 landmarks of the measurement "name" (see landmark_distance)
+        '''
+        key_a, key_b = self.landmark_distance[name]
+        landmark_a = self.get_landmark(key_a)
+        landmark_b = self.get_landmark(key_b)
+        distance = 'None'
+        
+        if landmark_a and landmark_b:
+            distance = round(self.get_distance(landmark_a, landmark_b),2)
+        return distance
+    
+    def measure_head_depth_lm(self):
+        '''
+        Head Height, height of the line going through the middle of the eye landmark #18
+        and its sanity check using start and end of the vertical line through the eye
+        return HH_lm, HH_lm_v2
+        '''
+        head_height, head_height_v2 = 'None', 'None'
+        
+        if self.get_landmark('18'):
+            head_height, start, end = self.measure_head_depth()
+            if head_height != 'None':
+                head_height_v2 = round(self.get_distance(start,end),2)
+        return head_height, head_height_v2
+    
     def all_measure_using_lm(self):        
         '''
         Collect all the measurment for the fish that are only using landmarks
         '''
-        landmark = self.landmark
-        measures_lm={'SL_lm':'None', 'HL_lm':'None','ED_lm':'None', 'HH_lm':'None', 'HH_lm_v2':'None', 'pOD_lm':'None' }
-        # Standard Length (body length), landmark
-        if landmark['1'] and landmark['6']:
-            measures_lm['SL_lm'] = round(self.get_distance(landmark['1'],landmark['6']),2)
-
-        # Head Length, landmark
-        if landmark['1'] and landmark['12']:
-            measures_lm['HL_lm'] = round(self.get_distance(landmark['1'],landmark['12']),2)
-            
-        #Eye Diamter, landmark
-        if landmark['14'] and landmark['15']:
-            measures_lm['ED_lm'] = round(self.get_distance(landmark['14'],landmark['15']),2)
-        
-        if landmark['18']:
-            # Head Height, height of the line going through the middle of the eye landmark #18
-            measures_lm['HH_lm'], start, end = self.measure_head_depth()
-            # Sanity check for the measure of HH_lm using start and end of the vertical line through the eye
-            measures_lm['HH_lm_v2'] = round(self.get_distance(start,end),2)
-            
-        # preObital Depth, landamrk
-        if landmark['1'] and landmark['14']:
-            measures_lm['pOD_lm'] = round(self.get_distance(landmark['1'],landmark['14']),2)
+        # Standard Length (body length), Head Length, Eye Diameter, Head Height, preObital Depth
+        list_measure = ['SL_lm', 'HL_lm', 'ED_lm', 'HH_lm', 'HH_lm_v2', 'pOD_lm']
+        measures_lm = {name: self.get_measure(name) for name in list_measure}
         
         # Head Depth, landmark
-        if landmark['2'] and landmark['13']:
-            measures_lm['HD_lm'] = round(self.get_distance(landmark['2'],landmark['13']),2)
+        if self.get_landmark('2') and self.get_landmark('13'):
+            measures_lm['HD_lm'] = self.get_measure('HD_lm')
         
-        measures_lm['FA_lm'] = self.measure_fish_angle_lm()
+        measures_lm['FA_lm'] = self.get_measure('FA_lm')
         
         return measures_lm    
 
@@ -563,9 +1252,9 @@ class Measure_morphology(Segmented_image):
         '''
         measure_area = {'EA_m':'None', 'HA_m':'None'}
         # Eye Area
-        measure_area['EA_m'] = self.measure_eye_area()
+        measure_area['EA_m'] = self.get_measure('EA_m')
         # Head area
-        measure_area['HA_m'] = self.measure_head_area()
+        measure_area['HA_m'] = self.get_measure('HA_m')
         
         return measure_area
                 
@@ -579,10 +1268,9 @@ class Measure_morphology(Segmented_image):
         Combine head and trunk and measure bbox length
         '''
         standard_length = 'None'
-        head_trunk = self.combine_trait_mask(['head','trunk'])
-        if np.any(head_trunk):
+        trait_region = self.get_trait_region(['head','trunk'])
+        if trait_region:
             
-            trait_region= self.clean_trait_region(head_trunk)
             min_row, min_col, max_row, max_col = trait_region.bbox # (up, left, bottom, right) <=> (min_row, min_col, max_row, max_col)
             standard_length = max_col-min_col
             
@@ -592,9 +1280,8 @@ class Measure_morphology(Segmented_image):
         '''
         Measure the length of bbox of the trait_name
         '''
-        mask = self.mask[trait_name]
         # remove the hole and take the biggest blob
-        trait_region = self.clean_trait_region(mask)
+        trait_region = self.get_trait_region(trait_name)
         trait_length_bbox = 'None'
         
         if trait_region:
@@ -609,10 +1296,8 @@ class Measure_morphology(Segmented_image):
         Measure preorbital Depth using left boubdary of bbox of head and eye
         '''
         pOD_bbox = 'None'
-        mask_head = self.mask['head']
-        mask_eye = self.mask['eye']
-        head_region = self.clean_trait_region(mask_head)
-        eye_region = self.clean_trait_region(mask_eye)
+        head_region = self.get_trait_region('head')
+        eye_region = self.get_trait_region('eye')
         
         if head_region and eye_region: 
             
@@ -631,50 +1316,38 @@ class Measure_morphology(Segmented_image):
         
         # SL standart length, length bbox of head+trunk
         
-        measures_bbox['SL_bbox'] =  self.measure_SL_bbox()
+        measures_bbox['SL_bbox'] =  self.get_measure('SL_bbox')
         
         # HL Head Length, length of bbox of the head
-        measures_bbox['HL_bbox'] = self.measure_length_bbox('head')
+        measures_bbox['HL_bbox'] = self.get_measure('HL_bbox')
         # ED Eye Diameter
-        measures_bbox['ED_bbox'] = self.measure_length_bbox('eye')
+        measures_bbox['ED_bbox'] = self.get_measure('ED_bbox')
 
         # preorbital Depth
-        measures_bbox['pOD_bbox'] = self.measure_pOD_bbox()
+        measures_bbox['pOD_bbox'] = self.get_measure('pOD_bbox')
         
         # fish angle in case of connection
-        measures_bbox['FA_pca'] = self.fish_angle
+        measures_bbox['FA_pca'] = self.get_measure('FA_pca')
          
         return measures_bbox
     
-    def visualize_landmark(self):
-            
-        landmark = self.all_landmark()
-        img_arr = self.img_arr
-        img = Image.fromarray(img_arr)
-        img1 = ImageDraw.Draw(img)
-        
-        #
-        #fnt = ImageFont.truetype("Pillow/Tests/fonts/FreeMono.ttf", 15)
-        fnt = ImageFont.load_default()
-        for i,(k,v) in enumerate(landmark.items()):
-            
-            # landmark exist draw it on the image
-            if v:
-                row,col = v
-                xy = [(col-9,row-9),(col+9,row+9)]
-                img1.ellipse(xy, fill='gray', outline=None, width=1)
-                
-                img1.text((col-6, row-6), k, font=fnt, fill='black')
-            # Display the image created
-        return img    
+    def visualize_landmark(self, scale=1, landmark=None):
+        '''
+        Draw the landmarks on the segmented image, see draw_landmark()
+        landmark: dictionnary of landmarks to draw, by default self.landmark (calculated once)
+        '''
+        if landmark is None:
+            landmark = self.landmark
+        return draw_landmark(self.label_map, landmark, scale, self.trait_color_dict)
     
 class Visualization_morphology(Measure_morphology):     
 ############################
 # Visualization function
 ############################
-    def __init__(self, file_name, align=True):
+    def __init__(self, file_name, align=True, cutoff=0.6, angle_tolerance=0, base_name=None, coarse_factor=1):
         
-        super().__init__(file_name, align=True)
+        super().__init__(file_name, align=align, cutoff=cutoff, angle_tolerance=angle_tolerance, base_name=base_name,
+                         coarse_factor=coarse_factor)
 
     def visualize_trait(self, trait):
         
@@ -687,27 +1360,6 @@ class Visualization_morphology(Measure_morphology):
         else:
             print(f'trait {trait} is not reference')
             
-    def visualize_landmark(self):
-            
-        landmark = self.all_landmark()
-        img_arr = self.img_arr
-        img = Image.fromarray(img_arr)
-        img1 = ImageDraw.Draw(img)
-        
-        #
-        #fnt = ImageFont.truetype("Pillow/Tests/fonts/FreeMono.ttf", 15)
-        fnt = ImageFont.load_default()
-        for i,(k,v) in enumerate(landmark.items()):
-            
-            # landmark exist draw it on the image
-            if v:
-                row,col = v
-                xy = [(col-9,row-9),(col+9,row+9)]
-                img1.ellipse(xy, fill='gray', outline=None, width=1)
-                
-                img1.text((col-6, row-6), k, font=fnt, fill='black')
-            # Display the image created
-        return img
         
     def visualize_a_bbox(self, trait_name):
 
@@ -717,7 +1369,7 @@ class Visualization_morphology(Measure_morphology):
         img1 = ImageDraw.Draw(img)
         
         # prepare the bbox for the "trait_name"
-        trait_prop = self.clean_trait_region(self.mask[trait_name])
+        trait_prop = self.get_trait_region(trait_name)
         top, left, bottom, right = trait_prop.bbox
 
         shape = [(left, top), (right,bottom)]
@@ -738,7 +1390,7 @@ class Visualization_morphology(Measure_morphology):
         for trait_name in list_trait_name:
             
             # prepare the bbox for the "trait_name"
-            trait_prop = self.clean_trait_region(self.mask[trait_name])
+            trait_prop = self.get_trait_region(trait_name)
             top, left, bottom, right = trait_prop.bbox
 
             shape = [(left, top), (right,bottom)]
@@ -752,7 +1404,7 @@ class Visualization_morphology(Measure_morphology):
     def visualize_major_minor(self):
         
         trait_mask = self.combine_trait_mask()
-        trait_region= self.clean_trait_region(trait_mask)
+        trait_region= self.get_trait_region(['head','trunk'])
         x0, y0 = trait_region.centroid
         orientation = trait_region.orientation
         xb0, yb0, xb1, yb1 = trait_region.bbox
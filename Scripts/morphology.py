@@ -101,15 +101,15 @@ def get_presence_matrix(mask):
     for i, (trait_name, trait_mask) in enumerate(mask.items()):
 
         temp_dict = {}
-        total_area = sum(sum(trait_mask))
-        label_trait = label(trait_mask)
-        regions_trait = regionprops(label_trait)
+        label_trait, number = label(trait_mask, return_num=True)
+        # area of every blob (index 0 is the background)
+        area = np.bincount(label_trait.ravel(), minlength=number + 1)
+        total_area = area[1:].sum()
 
-        temp_dict["number"] = len(regions_trait)
+        temp_dict["number"] = number
         
-        if len(regions_trait) > 0:
-             biggest_region = sorted(regions_trait, key=lambda r: r.area, reverse=True)[0]
-             temp_dict["percentage"] = biggest_region.area/total_area
+        if number > 0:
+             temp_dict["percentage"] = area[1:].max()/total_area
         else: 
             temp_dict["percentage"] = 0
 
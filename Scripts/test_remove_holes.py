@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Regression test of Segmented_image.remove_holes against the original hole filling,
+the morphological reconstruction by erosion of skimage with a seed equal to the border.
+
+Every trait mask of Test_Data/INHS_FISH_000742_segmented.png (before and after the
+alignment, full image and region of interest used by get_trait_region) is filled by
+both and the masks must be identical.
+    python -m pytest Scripts/test_remove_holes.py
+    python Scripts/test_remove_holes.py
+"""
+import os
+import numpy as np
+from skimage.morphology import reconstruction
+import Traits_class as tc
+
+test_image = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Test_Data',
+                          'INHS_FISH_000742_segmented.png')
+
+
+def remove_holes_reconstruction(image):
+    '''
+    Original implementation of remove_holes
+    '''
+    seed = np.copy(image)
+    seed[1:-1, 1:-1] = image.max()
+    mask = image
+    filled = reconstruction(seed, mask, method='erosion')
+    return filled
+
+def list_trait_mask(segmented):
+    '''
+    (name, mask) of every trait and of the combinations of the trait store,
+    on the full image and on the region of interest of get_trait_region
+    '''
+    list_mask = []
+    for key in [trait for trait in segmented.mask] + segmented.store_combinations:
+        list_trait = [key] if isinstance(key, str) else list(key)
+        if any(segmented.trait_area[segmented.trait_index[trait]] == 0 for trait in list_trait):
+            continue
+        list_mask.append((f'{key} full', segmented.combine_trait_mask(list_trait)))
+        roi = segmented.get_trait_roi(list_trait)
+        list_mask.append((f'{key} roi', segmented.combine_trait_mask(list_trait, roi=roi)))
+    return list_mask
+
+def check_remove_holes(segmented):
+    '''
+    return list of the masks filled differently
+    '''
+    list_diff = []
+    for name, mask in list_trait_mask(segmented):
+        expected = remove_holes_reconstruction(mask) > 0
+        actual = segmented.remove_holes(mask) > 0
+        if not np.array_equal(expected, actual):
+            list_diff.append(f'{name}: {np.count_nonzero(expected != actual)} pixels different')
+    return list_diff
+
+def test_remove_holes_not_aligned():
+    segmented = tc.Measure_morphology(test_image, align=False)
+    assert check_remove_holes(segmented) == []
+
+def test_remove_holes_aligned():
+    segmented = tc.Measure_morphology(test_image, align=True)
+    assert check_remove_holes(segmented) == []
+
+if __name__ == '__main__':
+    list_diff = []
+    for align in [False, True]:
+        list_diff += check_remove_holes(tc.Measure_morphology(test_image, align=align))
+    print('\n'.join(list_diff) or 'remove_holes identical to the reconstruction on every trait mask')